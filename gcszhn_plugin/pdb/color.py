@@ -1,4 +1,4 @@
-from pymol import cmd
+from ..utils import cmd
 from functools import lru_cache
 from ..utils import register_pymol_cmd
 
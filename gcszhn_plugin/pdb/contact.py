@@ -0,0 +1,172 @@
+import numpy as np
+import pandas as pd
+
+from typing import Dict, Tuple
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+from ..utils import (
+    register_pymol_cmd,
+    count_items,
+    get_atom_table,
+    select_indices,
+    report_progress,
+    RESIDUE_FIELDS)
+
+__all__ = ['residue_contacts']
+
+# atoms of first selection searched at a time,
+# which bounds memory of atom pairs in a block.
+CONTACT_BLOCK_ATOMS = 20000
+
+
+def _residue_ids(atoms: Dict[str, np.ndarray]) -> Tuple[np.ndarray, pd.DataFrame]:
+    residues = pd.DataFrame({k: atoms[k] for k in RESIDUE_FIELDS})
+    ids = residues.groupby(list(RESIDUE_FIELDS), sort=False).ngroup().to_numpy()
+    return ids, residues.drop_duplicates(ignore_index=True)
+
+
+def _min_by_key(keys: np.ndarray, dists: np.ndarray, counts: np.ndarray = None):
+    # unique keys with minimum distance and total count of each key
+    if counts is None:
+        counts = np.ones(len(keys), dtype=np.int64)
+    order = np.lexsort((dists, keys))
+    keys, dists, counts = keys[order], dists[order], counts[order]
+    if len(keys) == 0:
+        return keys, dists, counts
+    first = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[first], dists[first], np.add.reduceat(counts, first)
+
+
+def contact_pairs(
+        coords1: np.ndarray,
+        coords2: np.ndarray,
+        distance_threshold: float,
+        block_size: int = CONTACT_BLOCK_ATOMS):
+    """
+    Atom pairs closer than `distance_threshold` (exclusive,
+    as `extract_patch`), searched block by block.
+
+    Yields
+    ----------
+    Rows of `coords1`, rows of `coords2` and
+    distances of pairs in each block.
+    """
+    # sparse_distance_matrix is inclusive, shrink radius by one ulp
+    radius = np.nextafter(distance_threshold, 0)
+    tree2 = cKDTree(coords2)
+    for start in range(0, len(coords1), block_size):
+        report_progress(start, len(coords1), 'search contacts')
+        pairs = cKDTree(coords1[start:start + block_size]).sparse_distance_matrix(
+            tree2, radius, output_type='ndarray')
+        yield pairs['i'] + start, pairs['j'], pairs['v']
+
+
+@register_pymol_cmd
+def residue_contacts(
+        selection1: str,
+        selection2: str = None,
+        distance_threshold: float = 4.0,
+        output: str = 'table',
+        interface_name: str = None,
+        filename: str = None,
+        block_size: int = CONTACT_BLOCK_ATOMS):
+    """
+    Residue contact map between two selections, or among
+    residues of one selection. Two residues are in contact
+    if any of their atoms are closer than threshold.
+
+    Parameters
+    ----------
+    selection1 : str
+        pymol selection string.
+
+    selection2 : str, optional
+        pymol selection string. If not given, contacts
+        between different residues of selection1.
+
+    distance_threshold : float
+        The threshold of distance, exclusive.
+
+    output : str
+        "table" for a table of contacting residue pairs with
+        minimum distance and number of atom pairs,
+        "sparse" for (residue contact matrix of minimum
+        distance in CSR format, residues1, residues2).
+
+    interface_name : str, optional
+        If given, select interface residues as
+        `{interface_name}_1` and `{interface_name}_2`
+        by compact index ranges.
+
+    filename : str, optional
+        Save contact table as csv, or the sparse
+        matrix with residue labels as `.npz`.
+
+    block_size : int
+        Atoms of selection1 searched at a time.
+
+    Returns
+    ----------
+    Contact table or sparse contact map, see `output`.
+    """
+    if output not in ('table', 'sparse'):
+        raise ValueError(f"Unknown output: {output}")
+    fields = ('index',) + RESIDUE_FIELDS
+    atoms1 = get_atom_table(selection1, fields=fields, coords=True)
+    atoms2 = atoms1 if selection2 is None else get_atom_table(selection2, fields=fields, coords=True)
+    res_ids1, residues1 = _residue_ids(atoms1)
+    res_ids2, residues2 = _residue_ids(atoms2)
+    count_items(len(res_ids1) + len(res_ids2))
+
+    n_res2 = np.int64(len(residues2))
+    keys, dists, counts = [], [], []
+    for rows1, rows2, block_dists in contact_pairs(
+            atoms1['coord'], atoms2['coord'], float(distance_threshold), int(block_size)):
+        block_keys = res_ids1[rows1] * n_res2 + res_ids2[rows2]
+        if selection2 is None:
+            valid = res_ids1[rows1] != res_ids2[rows2]
+            block_keys, block_dists = block_keys[valid], block_dists[valid]
+        block_keys, block_dists, block_counts = _min_by_key(block_keys, block_dists)
+        keys.append(block_keys)
+        dists.append(block_dists)
+        counts.append(block_counts)
+
+    if keys:
+        # merge residue pairs found in different blocks
+        keys, dists, counts = _min_by_key(
+            np.concatenate(keys), np.concatenate(dists), np.concatenate(counts))
+    else:
+        keys, dists, counts = np.zeros(0, np.int64), np.zeros(0), np.zeros(0, np.int64)
+    res1, res2 = np.divmod(keys, max(n_res2, 1))
+
+    if interface_name:
+        select_indices(
+            f"{interface_name}_1",
+            atoms1['model'][np.isin(res_ids1, res1)],
+            atoms1['index'][np.isin(res_ids1, res1)])
+        select_indices(
+            f"{interface_name}_2",
+            atoms2['model'][np.isin(res_ids2, res2)],
+            atoms2['index'][np.isin(res_ids2, res2)])
+
+    if output == 'sparse':
+        matrix = csr_matrix((dists, (res1, res2)), shape=(len(residues1), len(residues2)))
+        if filename:
+            np.savez(
+                filename, row=res1, col=res2, distance=dists, atom_pairs=counts,
+                shape=np.array(matrix.shape),
+                **{f'residues1_{k}': residues1[k].to_numpy().astype(str) for k in RESIDUE_FIELDS},
+                **{f'residues2_{k}': residues2[k].to_numpy().astype(str) for k in RESIDUE_FIELDS})
+        return matrix, residues1, residues2
+
+    table = pd.concat([
+        residues1.iloc[res1].add_suffix('1').reset_index(drop=True),
+        residues2.iloc[res2].add_suffix('2').reset_index(drop=True)], axis=1)
+    table['distance'] = dists
+    table['atom_pairs'] = counts
+    if selection2 is None:
+        # each pair of one selection is found in both orders
+        table = table[res1 < res2].reset_index(drop=True)
+    if filename:
+        table.to_csv(filename, index=False)
+    return table
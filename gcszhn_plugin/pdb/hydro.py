@@ -1,18 +1,37 @@
 import numpy as np
 import pandas as pd
 
-from pymol import cmd
+from ..utils import cmd
 from colour import Color
 from importlib import resources
 from .sasa import get_sasa_by_res
-from ..utils import register_pymol_cmd, residue_with_CA, residue_format
+from scipy.spatial import cKDTree
+from ..utils import (
+    register_pymol_cmd,
+    residue_with_CA,
+    cached_property,
+    as_bool,
+    get_atom_table,
+    map_residue_values,
+    write_atom_values,
+    RESIDUE_KEYS,
+    RESIDUE_FIELDS,
+    on_cmd_thread,
+    call_on_cmd_thread,
+    report_progress,
+    submit_job)
 
 
 __all__ = [
     "set_hydro_color_v2",
     "set_hydro_color_v1",
     "avail_hydro_scales",
-    "set_hydration_color"]
+    "set_hydration_color",
+    "set_hydration_color_async"]
+
+# polar atoms searched at a time, so counting
+# reports progress and can be cancelled.
+HYDRATION_BLOCK_ATOMS = 50000
 
 # load scale.csv under current module dir
 with resources.open_text(__package__, "hydro_scale.csv") as f:
@@ -85,36 +104,19 @@ def set_hydro_color_v2(
     if type(minimum) is not type(maximum):
         raise ValueError("Please specific minimum and maximum both or not!")
 
-    auto_bound = minimum is None
-
-    if auto_bound:
-        minimum = float('inf')
-        maximum = -minimum
-
+    with_sasa = as_bool(with_sasa)
     if with_sasa:
         sasa_buffer = get_sasa_by_res(selection)
     
     selection = residue_with_CA(selection)
+    table = get_atom_table(selection, fields=RESIDUE_FIELDS)
+    values = HYDRO_SCALE_MAP[scale_name].reindex(table['resn']).fillna(0).to_numpy()
+    if with_sasa:
+        values = values * map_residue_values(table, sasa_buffer)
 
-    def set_hydro(resn, resi, chain, scale_name='Ja'):
-        nonlocal minimum, maximum
-        v = get_hydro(resn, scale_name=scale_name)
-        residue = residue_format(resn, resi, chain, selection)
-
-        if with_sasa:
-            sasa = sasa_buffer[residue]
-            v *= sasa
-
-        if auto_bound:
-            minimum = min(minimum, v)
-            maximum = max(maximum, v)
-
-        return v
-
-    cmd.alter(
-        selection,
-        f'b = set_hydro(resn, resi, chain, scale_name="{scale_name}")',
-        space={'set_hydro': set_hydro})
+    _minimum, _maximum = write_atom_values(selection, values)
+    if minimum is None:
+        minimum, maximum = _minimum, _maximum
     cmd.spectrum(
         'b',
         palette=palette,
@@ -155,13 +157,15 @@ def set_hydro_color_v1(
             maximum=maximum,
             min_color=min_color,
             max_color=max_color)
-        cmd.select('resn_sel', f'resn {resn} and {selection}')
         colorn = f'{resn}_color_sel_{selection}'
         cmd.set_color(
             colorn,
             res_color.get_rgb())
-        cmd.color(colorn, 'resn_sel')
-        cmd.delete('resn_sel')
+        try:
+            cmd.select('resn_sel', f'resn {resn} and {selection}')
+            cmd.color(colorn, 'resn_sel')
+        finally:
+            cmd.delete('resn_sel')
 
 
 def set_hydration(selection: str = '(all)', radius: float = 2.8, sasa_threshold: float = -1.0) -> tuple:
@@ -178,36 +182,68 @@ def set_hydration(selection: str = '(all)', radius: float = 2.8, sasa_threshold:
     radius: float
     TODO
     """
-    minimum = float('inf')
-    maximum = -minimum
+    radius = float(radius)
+    sasa_threshold = float(sasa_threshold)
     is_sasa = sasa_threshold >= 0
 
     selection = residue_with_CA(selection)
 
-    if is_sasa:
-        sasa_buffer = get_sasa_by_res(selection)
-
-    def _update(resn, resi, chain):
-        residue = residue_format(resn, resi, chain, selection)
-        count = cmd.count_atoms(
-            f"(resn HOH) within {radius} of ({residue} and elem N+O)")
-        if is_sasa:
-            if sasa_buffer[residue] < sasa_threshold:
-                count = 0
-        minimum = min(count, minimum)
-        maximum = max(count, maximum)
-        return count
-    
-    cmd.alter(
-        selection,
-        f'b = _update(resn, resi, chain)',
-        space={'_update': _update})
-
-    if minimum == float('inf'):
+    sasa_buffer = get_sasa_by_res(selection) if is_sasa else None
+    water_counts = cached_property(
+        'hydration', selection, {'radius': radius},
+        lambda: _count_hydration(selection, radius),
+        scope=f"(byobj ({selection})) or resn HOH")
+    report_progress(3, 3, 'store count')
+
+    return _store_hydration(selection, water_counts, sasa_buffer, sasa_threshold)
+
+
+def _count_hydration(selection: str, radius: float) -> dict:
+    report_progress(1, 3, 'fetch atoms')
+    polar_atoms, water_atoms = _fetch_hydration_atoms(selection)
+
+    # count distinct water atoms within radius of any polar atom of each residue
+    residue_fields = list(RESIDUE_KEYS)
+    residues = pd.DataFrame({k: polar_atoms[k] for k in residue_fields})
+    residue_ids = residues.groupby(residue_fields, sort=False).ngroup().to_numpy()
+    residues = residues.drop_duplicates()
+    polar_coords = polar_atoms['coord']
+    water_tree = cKDTree(water_atoms['coord'])
+    residue_water = [np.zeros((0, 2), dtype=np.int64)]
+    for start in range(0, len(polar_coords), HYDRATION_BLOCK_ATOMS):
+        report_progress(start, len(polar_coords), 'count water')
+        pairs = cKDTree(polar_coords[start:start + HYDRATION_BLOCK_ATOMS]).sparse_distance_matrix(
+            water_tree, radius, output_type='ndarray')
+        residue_water.append(np.unique(
+            np.stack([residue_ids[pairs['i'] + start], pairs['j']], axis=1), axis=0))
+    # a residue may span blocks, merge its waters
+    residue_water = np.unique(np.concatenate(residue_water), axis=0)
+    counts = np.bincount(residue_water[:, 0], minlength=len(residues))
+    return dict(zip(residues.itertuples(index=False, name=None), counts.tolist()))
+
+
+@on_cmd_thread
+def _fetch_hydration_atoms(selection: str) -> tuple:
+    polar_atoms = get_atom_table(
+        f"(byres ({selection})) and elem N+O",
+        fields=RESIDUE_KEYS,
+        coords=True)
+    water_atoms = get_atom_table("resn HOH", fields=('index',), coords=True)
+    return polar_atoms, water_atoms
+
+
+@on_cmd_thread
+def _store_hydration(selection: str, water_counts: dict, sasa_buffer: dict, sasa_threshold: float) -> tuple:
+    table = get_atom_table(selection, fields=RESIDUE_KEYS)
+    counts = map_residue_values(table, water_counts)
+    if sasa_buffer is not None:
+        counts[map_residue_values(table, sasa_buffer) < sasa_threshold] = 0
+
+    if len(counts) == 0:
         raise ValueError(
             f"No valid residue detected for selection {selection}")
 
-    return minimum, maximum
+    return write_atom_values(selection, counts)
 
 
 @register_pymol_cmd
@@ -227,4 +263,22 @@ def set_hydration_color(
     _minimum, _maximum = set_hydration(selection, radius, sasa_threshold=sasa_threshold)
     minimum = minimum if minimum is not None else _minimum
     maximum = maximum if maximum is not None else _maximum
-    cmd.spectrum('b', palette, selection, minimum=minimum, maximum=maximum)
+    call_on_cmd_thread(
+        cmd.spectrum, 'b', palette, selection, minimum=minimum, maximum=maximum)
+
+
+@register_pymol_cmd
+def set_hydration_color_async(
+        selection='(all)',
+        radius=2.8,
+        minimum: int = None,
+        maximum: int = None,
+        palette: str = "red_white_blue",
+        sasa_threshold: float = -1.0) -> int:
+    """
+    Run `set_hydration_color` as background job,
+    see `plugin_jobs` and `cancel_plugin_job`.
+    """
+    return submit_job(
+        'set_hydration_color', set_hydration_color,
+        selection, radius, minimum, maximum, palette, sasa_threshold).id
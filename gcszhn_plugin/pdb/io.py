@@ -1,12 +1,36 @@
+import io
+import sys
+import logging
 import pandas as pd
-from pymol import cmd
-from ..utils import register_pymol_cmd, int_array_to_str
+
+from contextlib import contextmanager
+from ..utils import cmd
+from ..utils import register_pymol_cmd, count_items, int_array_to_str
+
+# field separator of each copy mode
+COPY_MODES = {'tab': '\t', 'rf_hotspot': ',', 'range': '\t'}
+
+
+@contextmanager
+def _open_output(output: str, sep: str = '\t'):
+    # text stream of clipboard, stdout or file path
+    if output == "clipboard":
+        buffer = io.StringIO()
+        yield buffer
+        rows = [line.split(sep) for line in buffer.getvalue().splitlines()]
+        pd.DataFrame(rows).to_clipboard(index=False, header=False, sep=sep)
+    elif output == "stdout":
+        yield sys.stdout
+        sys.stdout.flush()
+    else:
+        with open(output, "w") as f:
+            yield f
 
 
 @register_pymol_cmd
-def copy_selection(selection: str = "(all)", mode="tab"):
+def copy_selection(selection: str = "(all)", mode="tab", output: str = "clipboard"):
     """
-    Copy selection to clipboard.
+    Copy residues of selection to clipboard, stdout or file.
 
     Parameters
     ----------
@@ -16,28 +40,59 @@ def copy_selection(selection: str = "(all)", mode="tab"):
         Copy mode. One of "tab", "rf_hotspot", "range".
         tab: copy chain, resi, resn to clipboard in TSV format.
         rf_hotspot: copy chain and resi in RFdiffusion hotspot format.
-        range: copy chain and resi in numerial range format.
+        range: copy chain and resi in numerial range format,
+            residues with insertion code are skipped with a warning.
+    output : str, optional
+        "clipboard", "stdout" or a file path. Residues are
+        written to stdout or file while iterating. Only
+        residues without single CA atom are remembered to
+        write them once, "range" mode keeps residue numbers.
     """
-    def _gen():
-        for atom in cmd.get_model(selection).atom:
-            yield atom.chain, atom.resi, atom.resn
-    
-    data = pd.DataFrame(_gen(), columns=['chain', 'resi', 'resn'])
-    # remove duplicated atoms
-    data = data.drop_duplicates(subset=['chain', 'resi', 'resn'])
-    if mode == "tab":
-        data.to_clipboard(index=False)
-    elif mode == "rf_hotspot":
-        resi = data['chain'] + data['resi']
-        resi = pd.DataFrame(resi, columns=['resi'])
-        resi.T.to_clipboard(index=False, sep=",", header=False)
-    elif mode == "range":
-        data_group = data.groupby("chain")
-        resi_range = data_group.apply(lambda d: int_array_to_str(d['resi'].astype(int), d.name))
-        resi_range.to_clipboard(index=False, header=False)
-    else:
+    if mode not in COPY_MODES:
         raise ValueError(f"Unknown mode: {mode}")
 
+    # one atom of each residue: CA if present, otherwise all
+    # atoms of the residue deduplicated below (ligands, waters).
+    residue_atoms = f"({selection}) and (name CA or not byres (({selection}) and name CA))"
+    seen = set()
+    first = True
+    chain_resi = {}
+    skipped = []
+    with _open_output(output, COPY_MODES[mode]) as out:
+        if mode == "tab":
+            out.write("chain\tresi\tresn\n")
+
+        def _write(name, alt, chain, resi, resn):
+            nonlocal first
+            # CA is unique in residue unless it has alternate locations
+            if name != "CA" or alt:
+                key = (chain, resi, resn)
+                if key in seen:
+                    return
+                seen.add(key)
+            if mode == "tab":
+                out.write(f"{chain}\t{resi}\t{resn}\n")
+            elif mode == "rf_hotspot":
+                out.write(f"{chain}{resi}" if first else f",{chain}{resi}")
+                first = False
+            else:
+                try:
+                    chain_resi.setdefault(chain, []).append(int(resi))
+                except ValueError:
+                    # insertion code, such as 100A
+                    skipped.append(f"{chain}{resi}")
+
+        count_items(cmd.iterate(
+            residue_atoms, "_write(name, alt, chain, resi, resn)", space={'_write': _write}))
+        if mode == "rf_hotspot":
+            out.write("\n")
+        elif mode == "range":
+            for chain in sorted(chain_resi):
+                out.write(int_array_to_str(chain_resi[chain], chain) + "\n")
+    if skipped:
+        logging.warning(
+            f"residues with insertion code are not in range output: {','.join(skipped)}")
+
 
 @register_pymol_cmd
 def save_by_objects(prefix: str = "", file_type: str = "pdb"):
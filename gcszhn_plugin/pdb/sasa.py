@@ -1,8 +1,22 @@
+import numpy as np
+import pandas as pd
+
 from typing import Dict
-from pymol import cmd
-from ..utils import local_setting, residue_format, register_pymol_cmd, residue_with_CA
+from ..utils import cmd
+from ..utils import (
+    cached_property,
+    get_atom_table,
+    local_setting,
+    register_pymol_cmd,
+    write_atom_values,
+    RESIDUE_KEYS,
+    RESIDUE_FIELDS,
+    on_cmd_thread,
+    call_on_cmd_thread,
+    report_progress,
+    submit_job)
 
-__all__ = ["set_sasa_color", "get_sasa"]
+__all__ = ["set_sasa_color", "set_sasa_color_async", "get_sasa", "get_atom_sasa"]
 
 
 @register_pymol_cmd
@@ -22,13 +36,41 @@ def get_sasa(
         return cmd.get_area(selection, load_b=load_b)
 
 
+@on_cmd_thread
+def get_atom_sasa(
+        selection: str,
+        solvent_radius: float = 1.4,
+        dot_density: int = 2) -> Dict[str, np.ndarray]:
+    """
+    Per-atom SASA of selection with residue properties,
+    aligned by atom order. Results are kept in the
+    property cache (see `plugin_cache`) until atoms of
+    the objects are moved, added or removed.
+    """
+    solvent_radius = float(solvent_radius)
+    dot_density = int(dot_density)
+
+    def _compute():
+        get_sasa(selection, solvent_radius=solvent_radius, load_b=1, dot_density=dot_density)
+        table = get_atom_table(selection, fields=RESIDUE_FIELDS + ('name', 'b'))
+        table['sasa'] = table.pop('b').astype(float)
+        return table
+
+    return cached_property(
+        'atom_sasa', selection,
+        {'solvent_radius': solvent_radius, 'dot_density': dot_density},
+        _compute)
+
+
 @register_pymol_cmd
 def set_sasa_color(
         selection:str = "(all)", 
         level: str = "A", 
         palette: str = 'red_white_blue',
         minimum: float = None,
-        maximum: float = None):
+        maximum: float = None,
+        solvent_radius: float = 1.4,
+        dot_density: int = 2):
     """
     Annotated color by sasa.
 
@@ -42,45 +84,30 @@ def set_sasa_color(
         'C' for chain level.
     - palette: str
         color palette of pymol.
+    - solvent_radius, dot_density:
+        parameters of SASA calculation, see `get_sasa`.
     
     """
     
     if type(minimum) is not type(maximum):
         raise ValueError("Please specific minimum and maximum both or not!")
-    
-    auto_bound = minimum is None
-    
-    if auto_bound:
-        minimum = float('inf')
-        maximum = -minimum
-
-    sasa_buffer = dict()
-
-    get_sasa(selection, load_b=1)
-
-    def set_sasa(resi, chain, b):
-        if level == "R":
-            res_sel_str = f'resi {resi} and chain {chain} and {selection}'
-        elif level == "C":
-            res_sel_str = f'chain {chain} and {selection}'
-
-        if level == 'A':
-            v = b
-        else:
-            if res_sel_str not in sasa_buffer:
-                sasa_buffer[res_sel_str] = sum(atom.b for atom in cmd.get_model(res_sel_str).atom)
-            v = sasa_buffer[res_sel_str]
-        
-        if auto_bound:
-            nonlocal minimum, maximum
-            minimum = min(minimum, v)
-            maximum = max(maximum, v)
-        return v
-    
-    cmd.alter(
-        selection,
-        f'b = set_sasa(resi, chain, b)',
-        space={'set_sasa': set_sasa})
+    if level not in ('A', 'R', 'C'):
+        raise ValueError(f"Unknown level: {level}")
+
+    report_progress(0, 3, 'compute sasa')
+    table = get_atom_sasa(selection, solvent_radius=solvent_radius, dot_density=dot_density)
+    report_progress(1, 3, 'sum sasa')
+    values = table['sasa']
+
+    if level != 'A':
+        keys = list(RESIDUE_KEYS) if level == 'R' else ['model', 'chain']
+        values = pd.DataFrame({k: table[k] for k in keys}).assign(sasa=values).groupby(
+            keys, sort=False)['sasa'].transform('sum').to_numpy()
+
+    report_progress(2, 3, 'store sasa')
+    _minimum, _maximum = write_atom_values(selection, values)
+    if minimum is None:
+        minimum, maximum = _minimum, _maximum
     cmd.spectrum(
         'b',
         palette=palette,
@@ -89,14 +116,33 @@ def set_sasa_color(
         maximum=maximum)
 
 
-def get_sasa_by_res(selection: str) -> Dict[str, float]:
-    get_sasa(selection=selection, load_b=1)
-    selection = residue_with_CA(selection)
-    sasa_dict = dict()
+@register_pymol_cmd
+def set_sasa_color_async(
+        selection:str = "(all)",
+        level: str = "A",
+        palette: str = 'red_white_blue',
+        minimum: float = None,
+        maximum: float = None,
+        solvent_radius: float = 1.4,
+        dot_density: int = 2) -> int:
+    """
+    Run `set_sasa_color` as background job,
+    see `plugin_jobs` and `cancel_plugin_job`.
+    SASA is computed by pymol itself, so the job
+    runs on the serialized pymol command queue.
+    """
+    return submit_job(
+        'set_sasa_color', call_on_cmd_thread, set_sasa_color,
+        selection, level, palette, minimum, maximum, solvent_radius, dot_density).id
 
-    def _update_res_sasa(atom):
-        residue = residue_format(atom.resn, atom.resi, atom.chain, selection)
-        sasa_dict[residue] = sum(atom.b for atom in cmd.get_model(residue).atom)
-    
-    cmd.iterate(selection, _update_res_sasa)
-    return sasa_dict
+
+def get_sasa_by_res(selection: str) -> Dict[tuple, float]:
+    """
+    SASA of CA atom of each residue, keyed by
+    `RESIDUE_KEYS`, from the cached per-atom SASA.
+    """
+    table = get_atom_sasa(selection)
+    residues = pd.DataFrame({k: table[k] for k in RESIDUE_KEYS})
+    residues['sasa'] = table['sasa']
+    residues = residues[table['name'] == 'CA']
+    return residues.groupby(list(RESIDUE_KEYS), sort=False)['sasa'].sum().to_dict()
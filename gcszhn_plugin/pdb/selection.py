@@ -1,4 +1,4 @@
-from pymol import cmd
+from ..utils import cmd
 from ..utils import register_pymol_cmd
 
 
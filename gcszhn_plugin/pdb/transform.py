@@ -1,28 +1,71 @@
+import numpy as np
 import pandas as pd
 
-from pymol import cmd
-from ..utils import register_pymol_cmd, int_array_to_str
+from ..utils import cmd
+from ..utils import register_pymol_cmd, get_atom_table, local_setting, select_indices, report_progress
 
-__all__ = ['copy_selection']
+__all__ = ['split_by_chain']
 
 
 @register_pymol_cmd
-def split_by_chain(obj_name: str = None):
+def split_by_chain(obj_name: str = None, by: str = 'chain', group_size: int = 1, state: int = 0):
     """
     Split object into multiple objects by chain.
+    Atoms are partitioned in one pass over an atom
+    table, and child objects are created in bulk
+    under deferred updates.
 
     Parameters
     ----------
     obj_name : str, optional
         Object name. If None, all objects will be processed.
+    by : str, optional
+        Split by "chain" or "segi".
+    group_size : int, optional
+        Number of chains (or segments) of each child
+        object, named `{obj}_{first}_{last}` if more than one.
+    state : int, optional
+        Coordinate state copied to child objects,
+        0 for all states.
     """
+    if by not in ('chain', 'segi'):
+        raise ValueError(f"Unknown split key: {by}")
+    group_size = max(int(group_size), 1)
     object_names = cmd.get_object_list()
     if obj_name and obj_name in object_names:
         object_names = [obj_name]
-    for obj in object_names:
-        chains = cmd.get_chains(obj)
-        if len(chains) > 1:
-            for chain in chains:
-                new_obj_name = f"{obj}_{chain}"
-                cmd.create(new_obj_name, f"{obj} and chain {chain}")
-            cmd.delete(obj)
+    with local_setting(defer_updates=1):
+        for i, obj in enumerate(object_names):
+            report_progress(i, len(object_names), 'split objects')
+            _split_object(obj, by, group_size, int(state))
+
+
+def _split_object(obj: str, by: str, group_size: int, state: int):
+    atoms = get_atom_table(f"model {obj}", fields=(by, 'index'))
+    keys, first = np.unique(atoms[by], return_index=True)
+    keys = atoms[by][np.sort(first)]
+    if len(keys) <= 1:
+        return
+    groups = [keys[i:i + group_size].tolist() for i in range(0, len(keys), group_size)]
+    group_of_key = {key: i for i, group in enumerate(groups) for key in group}
+    group_ids = pd.Series(atoms[by]).map(group_of_key).to_numpy()
+    names = [
+        f"{obj}_{group[0]}" if len(group) == 1 else f"{obj}_{group[0]}_{group[-1]}"
+        for group in groups]
+
+    if np.all(np.diff(group_ids) >= 0):
+        # each group is a contiguous index range, extracting from the
+        # last one keeps indices of remaining atoms and shrinks the object
+        bounds = np.searchsorted(group_ids, np.arange(len(groups) + 1))
+        for i in reversed(range(len(groups))):
+            start, end = atoms['index'][bounds[i]], atoms['index'][bounds[i + 1] - 1]
+            cmd.extract(names[i], f"model {obj} and index {start}-{end}", source_state=state, zoom=0)
+    else:
+        try:
+            for i, name in enumerate(names):
+                rows = group_ids == i
+                select_indices("split_atoms", np.full(rows.sum(), obj), atoms['index'][rows])
+                cmd.create(name, "split_atoms", source_state=state, zoom=0)
+        finally:
+            cmd.delete("split_atoms")
+    cmd.delete(obj)
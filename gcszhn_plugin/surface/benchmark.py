@@ -0,0 +1,115 @@
+import time
+import tracemalloc
+import numpy as np
+
+from ..utils import cmd
+from contextlib import contextmanager
+from .mesh_utils import Mesh
+from .ply import (
+    build_ply_cgo, load_cgo_group, build_vertex_layer,
+    load_layer, charge_color, colorDict, VERTEX_MODES)
+from ..utils import register_pymol_cmd, traced_peak
+
+__all__ = ['benchmark_cgo', 'benchmark_vertex_modes']
+
+
+@contextmanager
+def _measure(result: dict, key: str):
+    """
+    Measure wall time and peak python allocation
+    (numpy buffers included) of the block. Memory traced
+    by `plugin_stats` keeps its own peaks.
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with traced_peak() as peak:
+            yield
+    finally:
+        result[f'{key}_time'] = time.perf_counter() - start
+        result[f'{key}_peak_mb'] = peak[0] / 2 ** 20
+        if started:
+            tracemalloc.stop()
+
+
+@register_pymol_cmd
+def benchmark_cgo(filename: str, repeat: int = 3, load: bool = True) -> list:
+    """
+    Benchmark CGO build of `load_ply`, reporting
+    wall time and peak memory of building and loading.
+
+    Parameters
+    ----------
+    filename: str
+        Mesh file.
+    repeat: int
+        Number of runs.
+    load: bool
+        Also load CGO into pymol and measure it.
+    """
+    results = []
+    for i in range(int(repeat)):
+        result = dict()
+        group_name = f"benchmark_cgo_{i}"
+        with _measure(result, 'build'):
+            group_name, cgo_objects = build_ply_cgo(filename, group_name)
+        result['buffer_mb'] = sum(obj.nbytes for _, obj in cgo_objects) / 2 ** 20
+        if load:
+            with _measure(result, 'load'):
+                load_cgo_group(group_name, cgo_objects)
+            cmd.delete(group_name)
+        results.append(result)
+        print(", ".join(f"{k}={v:.3f}" for k, v in result.items()))
+    return results
+
+
+@register_pymol_cmd
+def benchmark_vertex_modes(filename: str, vertex_size: float = 0.2, point_size: float = 3.0, frames: int = 30) -> list:
+    """
+    Compare build time, load time and frame rate of
+    vertex rendering modes of `load_ply`. Frame rate
+    is only meaningful with a visible viewer.
+
+    Parameters
+    ----------
+    filename: str
+        Mesh file.
+    frames: int
+        Number of frames rendered for frame rate.
+    """
+    mesh = Mesh.read(filename)
+    verts = mesh.vertices
+    if 'vertex_charge' in mesh.attribute_names:
+        colors = charge_color(mesh.get_attribute('vertex_charge'))
+    else:
+        colors = np.tile(colorDict['green'], (len(verts), 1))
+
+    results = []
+    frames = int(frames)
+    # only the benchmarked layer is shown, the other objects
+    # are shown again afterwards, even if benchmark fails.
+    enabled = cmd.get_names('objects', enabled_only=1)
+    try:
+        for vertex_mode in VERTEX_MODES:
+            result = dict()
+            name = f"benchmark_{vertex_mode}"
+            with _measure(result, 'build'):
+                layer = build_vertex_layer(verts, colors, vertex_mode, vertex_size, point_size)
+            with _measure(result, 'load'):
+                load_layer(name, layer)
+            cmd.disable('all')
+            cmd.enable(name)
+            start = time.perf_counter()
+            for _ in range(frames):
+                cmd.turn('y', 360.0 / frames)
+                cmd.refresh()
+            result['fps'] = frames / (time.perf_counter() - start)
+            cmd.delete(name)
+            results.append(result)
+            print(f"{vertex_mode}: " + ", ".join(f"{k}={v:.3f}" for k, v in result.items()))
+    finally:
+        for obj in enabled:
+            cmd.enable(obj)
+    return results
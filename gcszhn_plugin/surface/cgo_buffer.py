@@ -0,0 +1,194 @@
+from typing import Iterator, Tuple
+import numpy as np
+
+from ..utils import cmd
+from pymol.cgo import BEGIN, END, VERTEX, NORMAL, COLOR, SPHERE, POINTS, LINES, TRIANGLES, LINEWIDTH
+
+__all__ = ['CGOBuffer', 'load_cgo_buffer']
+
+# number of primitives per block, buffer is only
+# split into chunks at block boundaries.
+CGO_BLOCK_ITEMS = 65536
+# maximum floats of one CGO object, larger buffers
+# are loaded as a group of chunked CGO objects.
+CGO_CHUNK_FLOATS = 1 << 22
+
+
+class CGOBuffer:
+    """
+    CGO buffer backed by a preallocated float32 array,
+    filled by vectorized typed append helpers. Every
+    block written by the helpers is self-contained
+    (with its own BEGIN/END and COLOR), so the buffer
+    can be split into chunked CGO objects. `settings`
+    are applied to loaded objects, such as `cgo_dot_width`.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._data = np.empty(max(int(capacity), 16), dtype=np.float32)
+        self._size = 0
+        self._marks = [0]
+        self.settings = dict()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = self._data[:self._size]
+        return state
+
+    @property
+    def nbytes(self) -> int:
+        return self._data.nbytes
+
+    def reserve(self, n: int):
+        """
+        Make room for `n` more floats.
+        """
+        required = self._size + n
+        if required > len(self._data):
+            data = np.empty(max(required, 2 * len(self._data)), dtype=np.float32)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+
+    def _alloc(self, n: int) -> np.ndarray:
+        self.reserve(n)
+        view = self._data[self._size:self._size + n]
+        self._size += n
+        return view
+
+    def _mark(self):
+        if self._marks[-1] != self._size:
+            self._marks.append(self._size)
+
+    def extend(self, values):
+        """
+        Append raw CGO floats as one block.
+        """
+        values = np.asarray(values, dtype=np.float32).ravel()
+        self._alloc(len(values))[:] = values
+        self._mark()
+
+    def spheres(self, centers: np.ndarray, radius, colors: np.ndarray = None, color=None):
+        """
+        Append spheres, with per-sphere `colors` (N, 3),
+        or one `color` for all of them.
+        """
+        centers = np.asarray(centers, dtype=np.float32).reshape(-1, 3)
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float32), len(centers))
+        width = 9 if colors is not None else 5
+        for start in range(0, len(centers), CGO_BLOCK_ITEMS):
+            end = min(start + CGO_BLOCK_ITEMS, len(centers))
+            if color is not None:
+                self._alloc(4)[:] = (COLOR, *color)
+            rows = self._alloc((end - start) * width).reshape(-1, width)
+            if colors is not None:
+                rows[:, 0] = COLOR
+                rows[:, 1:4] = colors[start:end]
+            rows[:, -5] = SPHERE
+            rows[:, -4:-1] = centers[start:end]
+            rows[:, -1] = radius[start:end]
+            self._mark()
+
+    def points(self, vertices: np.ndarray, colors: np.ndarray = None, color=None):
+        """
+        Append points, with per-point `colors` (N, 3),
+        or one `color` for all of them. Point size is
+        controlled by `cgo_dot_width` setting.
+        """
+        vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, 3)
+        width = 8 if colors is not None else 4
+        for start in range(0, len(vertices), CGO_BLOCK_ITEMS):
+            end = min(start + CGO_BLOCK_ITEMS, len(vertices))
+            self._alloc(2)[:] = (BEGIN, POINTS)
+            if color is not None:
+                self._alloc(4)[:] = (COLOR, *color)
+            rows = self._alloc((end - start) * width).reshape(-1, width)
+            if colors is not None:
+                rows[:, 0] = COLOR
+                rows[:, 1:4] = colors[start:end]
+            rows[:, -4] = VERTEX
+            rows[:, -3:] = vertices[start:end]
+            self._alloc(1)[0] = END
+            self._mark()
+
+    def lines(self, starts: np.ndarray, ends: np.ndarray, color=None, width: float = None):
+        """
+        Append line segments from `starts` to `ends`.
+        """
+        starts = np.asarray(starts, dtype=np.float32).reshape(-1, 3)
+        ends = np.asarray(ends, dtype=np.float32).reshape(-1, 3)
+        for start in range(0, len(starts), CGO_BLOCK_ITEMS):
+            end = min(start + CGO_BLOCK_ITEMS, len(starts))
+            if width is not None:
+                self._alloc(2)[:] = (LINEWIDTH, width)
+            self._alloc(2)[:] = (BEGIN, LINES)
+            if color is not None:
+                self._alloc(4)[:] = (COLOR, *color)
+            rows = self._alloc((end - start) * 8).reshape(-1, 8)
+            rows[:, 0] = VERTEX
+            rows[:, 1:4] = starts[start:end]
+            rows[:, 4] = VERTEX
+            rows[:, 5:8] = ends[start:end]
+            self._alloc(1)[0] = END
+            self._mark()
+
+    def triangles(self, vertices: np.ndarray, faces: np.ndarray, colors: np.ndarray, normals: np.ndarray):
+        """
+        Append triangles with per-vertex colors and normals.
+        """
+        faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+        for start in range(0, len(faces), CGO_BLOCK_ITEMS):
+            corners = faces[start:start + CGO_BLOCK_ITEMS].ravel()
+            self._alloc(2)[:] = (BEGIN, TRIANGLES)
+            rows = self._alloc(len(corners) * 12).reshape(-1, 12)
+            rows[:, 0] = COLOR
+            rows[:, 1:4] = colors[corners]
+            rows[:, 4] = NORMAL
+            rows[:, 5:8] = normals[corners]
+            rows[:, 8] = VERTEX
+            rows[:, 9:12] = vertices[corners]
+            self._alloc(1)[0] = END
+            self._mark()
+
+    def chunks(self, max_floats: int = CGO_CHUNK_FLOATS) -> Iterator[Tuple[int, int]]:
+        """
+        Split buffer at block boundaries into (start, end)
+        ranges of at most `max_floats`, unless a single
+        block is larger.
+        """
+        self._mark()
+        chunk_start = 0
+        previous = 0
+        for mark in self._marks[1:]:
+            if mark - chunk_start > max_floats and previous > chunk_start:
+                yield chunk_start, previous
+                chunk_start = previous
+            previous = mark
+        if previous > chunk_start or not self._size:
+            yield chunk_start, previous
+
+    def to_list(self, start: int = 0, end: int = None) -> list:
+        end = self._size if end is None else end
+        return self._data[start:end].tolist()
+
+
+def load_cgo_buffer(buffer: CGOBuffer, name: str, state=0, max_floats: int = CGO_CHUNK_FLOATS) -> str:
+    """
+    Load CGO buffer as object `name`. Buffers larger than
+    `max_floats` are loaded as a group of chunked objects,
+    so only one chunk is converted to python list at a time.
+    """
+    chunks = list(buffer.chunks(max_floats))
+    if len(chunks) == 1:
+        part_names = [name]
+    else:
+        part_names = [f"{name}_part{i}" for i in range(1, len(chunks) + 1)]
+    for part_name, (start, end) in zip(part_names, chunks):
+        cmd.load_cgo(buffer.to_list(start, end), part_name, state)
+        for setting, value in buffer.settings.items():
+            cmd.set(setting, value, part_name)
+    if len(chunks) > 1:
+        cmd.group(name, " ".join(part_names))
+    return name
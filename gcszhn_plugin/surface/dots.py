@@ -1,9 +1,15 @@
-from pymol import cmd
 from pymol.cgo import *
-from ..utils import register_pymol_cmd
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import cKDTree
+from ..utils import register_pymol_cmd, count_items, get_atom_table, as_bool, report_progress
+from .cgo_buffer import CGOBuffer, load_cgo_buffer
+from .ply import build_vertex_layer, load_layer
 import numpy as np
 
-__all__ = ['load_dots']
+__all__ = ['load_dots', 'generate_dots']
+
+# atoms whose dots are tested at a time
+DOTS_CHUNK_ATOMS = 4096
 
 colorDict = {'sky': [COLOR, 0.0, 0.76, 1.0 ],
         'sea': [COLOR, 0.0, 0.90, 0.5 ],
@@ -21,53 +27,151 @@ colorDict = {'sky': [COLOR, 0.0, 0.76, 1.0 ],
 
 
 @register_pymol_cmd
-def load_dots(filename, color="white", name='ply', dotSize=0.2, lineSize = 0.5, doStatistics=False):
-    lines = open(filename).readlines()
-    lines = [line.rstrip() for line in lines]
-    lines = [line.split(',') for line in lines]
-    verts = [[float(x[0]), float(x[1]), float(x[2])] for x in lines]
+def load_dots(filename, color="white", name='ply', dotSize=0.2, lineSize = 0.5, doStatistics=False,
+              mode='sphere', pointSize=3.0):
+    """
+    Load dots (x,y,z[,nx,ny,nz] per line) and their normals.
+
+    Parameters
+    ----------
+    mode: str
+        "sphere" for CGO spheres of radius `dotSize`,
+        "points" for CGO points of width `pointSize`
+        pixels, "atoms" for pseudoatoms drawn as spheres.
+    """
+    data = np.loadtxt(filename, delimiter=',', ndmin=2)
+    verts = data[:, :3]
+    count_items(len(verts))
 
     normals = None
 
-    if len(lines[0]) > 3:
+    if data.shape[1] > 3:
         # normal is the last column - draw it  
-        normals = [[float(x[3]), float(x[4]), float(x[5])] for x in lines]
-     
+        normals = data[:, 3:6]
+
+    _draw_dots(verts, normals, colorDict[color][1:], "vert_"+filename, "norm_"+filename,
+               dotSize, mode, pointSize)
+
+
+def _draw_dots(verts, normals, color, vert_name, norm_name, dotSize=0.2, mode='sphere', pointSize=3.0):
     # Draw vertices 
-    obj = []
-
-    for v_ix in range(len(verts)):
-        colorToAdd = colorDict[color]
-        vert = verts[v_ix]
-        # Vertices
-        obj.extend(colorToAdd)
-        obj.extend([SPHERE, vert[0], vert[1], vert[2], dotSize])
-#    obj.append(END)
-    name = "vert_"+filename
-    group_names = name
-    cmd.load_cgo(obj,name, 1.0)
-    obj = []
+    obj = build_vertex_layer(
+        verts, np.tile(color, (len(verts), 1)), mode, dotSize, pointSize)
+    load_layer(vert_name, obj, 1.0)
     # Draw normals
     if normals is not None:
-        colorToAdd = colorDict['white']
-        obj.extend([BEGIN, LINES])
-        obj.extend([LINEWIDTH, 2.0])
-        colorToAdd = colorDict[color]
-        obj.extend(colorToAdd)
-        for v_ix in range(len(verts)): 
-            vert1 = verts[v_ix]
-            vert2 = np.array(verts[v_ix])+np.array(normals[v_ix])
-            obj.extend([VERTEX, (vert1[0]), (vert1[1]), (vert1[2])])
-            obj.extend([VERTEX, (vert2[0]), (vert2[1]), (vert2[2])])
-#        obj.append(END)
-        name = "norm_"+filename
-        group_names = name
-        cmd.load_cgo(obj,name, 1.0)
-    # Draw normals
+        obj = CGOBuffer(len(verts) * 8 + 16)
+        obj.lines(verts, verts + normals, color=color, width=2.0)
+        load_cgo_buffer(obj, norm_name, 1.0)
+
 
+def sphere_points(n: int) -> np.ndarray:
+    """
+    `n` nearly uniform unit vectors on a golden spiral.
+    """
+    k = np.arange(n) + 0.5
+    z = 1 - 2 * k / n
+    r = np.sqrt(1 - z * z)
+    phi = np.pi * (1 + 5 ** 0.5) * k
+    return np.column_stack([r * np.cos(phi), r * np.sin(phi), z])
 
-            
-               
-            
 
+def surface_dots(
+        coords: np.ndarray,
+        radii: np.ndarray,
+        probe_radius: float = 1.4,
+        n_points: int = 64,
+        surface: str = 'sas',
+        chunk_size: int = DOTS_CHUNK_ATOMS,
+        workers: int = 0):
+    """
+    Dots of solvent accessible surface (on spheres of radius
+    `radii + probe_radius`), or of contact surface (the
+    accessible part of spheres of `radii`).
+
+    A dot is accessible if it is not inside the expanded
+    sphere of any other atom, tested by KD-tree pairs of
+    dots and atoms. Chunks of atoms are processed in
+    a thread pool.
+
+    Returns
+    ----------
+    Dots and their outward unit normals, both (N, 3),
+    and the atom row each dot belongs to.
+    """
+    coords = np.asarray(coords, dtype=float)
+    expanded = np.asarray(radii, dtype=float) + probe_radius
+    if len(coords) == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3)), np.zeros(0, dtype=np.int64)
+    units = sphere_points(int(n_points))
+    atoms_tree = cKDTree(coords)
+    max_radius = expanded.max()
+
+    def _chunk(start):
+        owners = np.repeat(np.arange(start, min(start + chunk_size, len(coords))), len(units))
+        normals = np.tile(units, (len(owners) // len(units), 1))
+        dots = coords[owners] + normals * expanded[owners, None]
+        pairs = cKDTree(dots).sparse_distance_matrix(
+            atoms_tree, max_radius, output_type='ndarray')
+        # inside expanded sphere of another atom, with a little
+        # tolerance so dots of the owner atom are kept
+        buried = (pairs['v'] < expanded[pairs['j']] - 1e-6) & (pairs['j'] != owners[pairs['i']])
+        accessible = np.ones(len(dots), dtype=bool)
+        accessible[pairs['i'][buried]] = False
+        return owners[accessible], normals[accessible]
+
+    starts = range(0, len(coords), chunk_size)
+    results = []
+    with ThreadPoolExecutor(max_workers=int(workers) or None) as executor:
+        futures = [executor.submit(_chunk, start) for start in starts]
+        try:
+            for future in futures:
+                results.append(future.result())
+                report_progress(min(len(results) * chunk_size, len(coords)), len(coords), 'test dots')
+        finally:
+            for future in futures:
+                future.cancel()
+    owners = np.concatenate([owner for owner, _ in results])
+    normals = np.concatenate([normal for _, normal in results])
+    radius = expanded[owners] if surface == 'sas' else expanded[owners] - probe_radius
+    return coords[owners] + normals * radius[:, None], normals, owners
+
+
+@register_pymol_cmd
+def generate_dots(selection: str = "(all)", surface: str = 'sas', probe_radius: float = 1.4,
+                  n_points: int = 64, filename: str = None, name: str = 'dots', color: str = "white",
+                  dotSize: float = 0.2, mode: str = 'points', pointSize: float = 3.0,
+                  normals: bool = True, workers: int = 0):
+    """
+    Generate solvent accessible ("sas") or contact ("contact")
+    dot surface of selection from atom coordinates and vdw
+    radii, and draw it as `load_dots`.
 
+    Parameters
+    ----------
+    probe_radius: float
+        Solvent probe radius.
+    n_points: int
+        Dots sampled per atom sphere.
+    filename: str
+        If given, save dots as csv (x,y,z,nx,ny,nz per line)
+        readable by `load_dots`, instead of drawing them.
+    name: str
+        Dots are drawn as `vert_{name}` and `norm_{name}`.
+    normals: bool
+        Also draw normals.
+    workers: int
+        Number of threads, 0 for number of cores.
+    """
+    if surface not in ('sas', 'contact'):
+        raise ValueError(f"Unknown surface: {surface}")
+    atoms = get_atom_table(selection, fields=('vdw',), coords=True)
+    count_items(len(atoms['coord']))
+    dots, dot_normals, _ = surface_dots(
+        atoms['coord'], atoms['vdw'].astype(float), float(probe_radius),
+        int(n_points), surface, workers=int(workers))
+    if filename:
+        np.savetxt(filename, np.hstack([dots, dot_normals]), delimiter=',', fmt='%.4f')
+        return
+    _draw_dots(dots, dot_normals if as_bool(normals) else None, colorDict[color][1:],
+               "vert_" + name, "norm_" + name, float(dotSize), mode, float(pointSize))
@@ -0,0 +1,146 @@
+import os
+import numpy as np
+import pandas as pd
+
+from scipy.spatial import cKDTree
+from .mesh_utils import Mesh, register_mesh
+from .ply import build_mesh_cgo, load_cgo_group
+from ..utils import register_pymol_cmd, count_items, get_atom_table, report_progress, as_bool
+
+__all__ = ['compute_surface_potential']
+
+# formal charge of titratable residues at pH 7,
+# placed on the atom at the center of the charged group.
+RESIDUE_CHARGES = {
+    ('ARG', 'CZ'): 1.0,
+    ('LYS', 'NZ'): 1.0,
+    ('ASP', 'CG'): -1.0,
+    ('GLU', 'CD'): -1.0,
+}
+
+# Coulomb constant divided by kT at 298 K, in angstrom,
+# so potentials are in kT/e.
+COULOMB_KT = 560.4
+
+# maximum entries of (vertices, atoms) matrix of one dense block
+POTENTIAL_BLOCK_ENTRIES = 1 << 22
+# vertices of one block of cutoff pair search
+POTENTIAL_BLOCK_VERTICES = 65536
+
+
+def screened_coulomb(
+        points: np.ndarray,
+        charge_coords: np.ndarray,
+        charges: np.ndarray,
+        debye_length: float = 8.0,
+        dielectric: float = 4.0,
+        cutoff: float = 12.0,
+        min_distance: float = 1.0) -> np.ndarray:
+    """
+    Screened Coulomb (Debye-Huckel) potential in kT/e at each
+    point, `COULOMB_KT * sum(q * exp(-r / debye_length) / (dielectric * r))`.
+    With a positive `cutoff`, only charges closer than cutoff
+    are summed by KD-tree pairs, otherwise by dense blocks.
+    """
+    potential = np.zeros(len(points))
+    if len(charges) == 0:
+        return potential
+    scale = COULOMB_KT / dielectric
+
+    def _terms(dists, q):
+        dists = np.maximum(dists, min_distance)
+        return scale * q * np.exp(-dists / debye_length) / dists
+
+    if cutoff and cutoff > 0:
+        charge_tree = cKDTree(charge_coords)
+        block_size = POTENTIAL_BLOCK_VERTICES
+        for start in range(0, len(points), block_size):
+            report_progress(start, len(points), 'sum potential')
+            pairs = cKDTree(points[start:start + block_size]).sparse_distance_matrix(
+                charge_tree, cutoff, output_type='ndarray')
+            potential[start:start + block_size] = np.bincount(
+                pairs['i'], weights=_terms(pairs['v'], charges[pairs['j']]),
+                minlength=len(points[start:start + block_size]))
+    else:
+        block_size = max(1, POTENTIAL_BLOCK_ENTRIES // len(charges))
+        for start in range(0, len(points), block_size):
+            report_progress(start, len(points), 'sum potential')
+            block = points[start:start + block_size]
+            dists = np.linalg.norm(block[:, None, :] - charge_coords[None, :, :], axis=2)
+            potential[start:start + block_size] = _terms(dists, charges[None, :]).sum(axis=1)
+    return potential
+
+
+@register_pymol_cmd
+def compute_surface_potential(
+        ply_file: str,
+        selection: str = '(all)',
+        charges: str = 'residue',
+        debye_length: float = 8.0,
+        dielectric: float = 4.0,
+        cutoff: float = 12.0,
+        scale: float = 10.0,
+        group_name: str = None,
+        load: bool = True) -> np.ndarray:
+    """
+    Compute screened Coulomb potential of selection at
+    mesh vertices, stored as `vertex_charge` attribute and
+    drawn as `load_ply`, for meshes without charge.
+
+    Parameters
+    ----------
+    ply_file: str
+        Mesh file.
+    selection: str
+        pymol selection string of the structure.
+    charges: str
+        "residue" for formal charges of ARG, LYS, ASP, GLU
+        (see `RESIDUE_CHARGES`), "partial" for atom
+        `partial_charge`, such as loaded from PQR file.
+    debye_length: float
+        Debye screening length in angstrom.
+    dielectric: float
+        Relative dielectric constant.
+    cutoff: float
+        Charges farther than cutoff are ignored,
+        0 to sum all charges.
+    scale: float
+        Potential (kT/e) mapped to charge color -1 to 1.
+    group_name: str
+        Group name of loaded layers, see `load_ply`.
+    load: bool
+        If False, only compute and store potential, the
+        mesh is registered as `group_name` for `save_ply`.
+
+    Returns
+    ----------
+    Potential of each vertex in kT/e.
+    """
+    if charges not in ('residue', 'partial'):
+        raise ValueError(f"Unknown charges: {charges}")
+    mesh = Mesh.read(ply_file)
+    atoms = get_atom_table(selection, fields=('resn', 'name', 'partial_charge'), coords=True)
+    if charges == 'residue':
+        keys = pd.MultiIndex.from_arrays([atoms['resn'], atoms['name']])
+        atom_charges = pd.Series(RESIDUE_CHARGES).reindex(keys).fillna(0).to_numpy()
+    else:
+        atom_charges = atoms['partial_charge'].astype(float)
+    charged = atom_charges != 0
+    count_items(int(charged.sum()) + len(mesh.vertices))
+
+    potential = screened_coulomb(
+        np.asarray(mesh.vertices, dtype=float),
+        atoms['coord'][charged], atom_charges[charged],
+        debye_length=float(debye_length),
+        dielectric=float(dielectric),
+        cutoff=float(cutoff))
+    mesh.set_attribute('vertex_charge', potential / float(scale))
+
+    if not group_name:
+        group_name = os.path.basename(ply_file).split('.')[0]
+    load = as_bool(load)
+    # a mesh not loaded is kept, so it can still be saved by `save_ply`
+    register_mesh(group_name, mesh, keep=not load)
+    if load:
+        load_cgo_group(group_name, build_mesh_cgo(mesh, group_name))
+    return potential
@@ -0,0 +1,130 @@
+import numpy as np
+
+from typing import List, Sequence, Union
+from scipy.spatial import cKDTree
+from scipy.sparse.csgraph import dijkstra
+from .mesh_utils import Mesh
+from .patch import PatchList, atoms_near_vertices, _create_patch_objects
+from .projection import nearest_vertices
+from ..utils import register_pymol_cmd, count_items, get_atom_table, report_progress
+
+__all__ = ['geodesic_patches', 'geodesic_patch']
+
+# maximum entries of the (seeds, vertices) distance
+# matrix of one batched shortest-path search.
+GEODESIC_BATCH_ENTRIES = 1 << 24
+
+
+def geodesic_patches(mesh: Mesh, seeds: Sequence[int], radius: float) -> PatchList:
+    """
+    Grow patches of geodesic `radius` around seed
+    vertices, by shortest-path search over the mesh
+    adjacency limited to `radius`. Seeds are searched
+    in batches to bound memory.
+
+    Returns
+    ----------
+    Patch list with seeds as patch ids. Vertices of each
+    patch are sorted by geodesic distance, so the seed
+    comes first as MaSIF patch lists.
+    """
+    seeds = np.asarray(seeds, dtype=np.int64).ravel()
+    n_vertices = len(mesh.vertices)
+    if np.any((seeds < 0) | (seeds >= n_vertices)):
+        raise ValueError(f"Seed vertex out of range [0, {n_vertices})")
+    adjacency = mesh.adjacency
+    batch_size = max(1, GEODESIC_BATCH_ENTRIES // max(n_vertices, 1))
+    lengths = []
+    indices = []
+    for start in range(0, len(seeds), batch_size):
+        report_progress(start, len(seeds), 'search patches')
+        dists = dijkstra(
+            adjacency, directed=True, indices=seeds[start:start + batch_size],
+            limit=float(radius))
+        rows, cols = np.nonzero(np.isfinite(dists))
+        order = np.lexsort((dists[rows, cols], rows))
+        lengths.append(np.bincount(rows, minlength=len(dists)))
+        indices.append(cols[order].astype(np.int32))
+    count_items(n_vertices + len(seeds))
+    indptr = np.zeros(len(seeds) + 1, dtype=np.int64)
+    if lengths:
+        np.cumsum(np.concatenate(lengths), out=indptr[1:])
+        indices = np.concatenate(indices)
+    else:
+        indices = np.zeros(0, dtype=np.int32)
+    return PatchList(indptr, indices, ids=seeds)
+
+
+def _parse_ids(ids: Union[str, Sequence[int]]) -> List[int]:
+    if isinstance(ids, str):
+        return [int(i) for i in ids.replace('+', ',').split(',') if i.strip()]
+    return [int(i) for i in ids]
+
+
+@register_pymol_cmd
+def geodesic_patch(ply_file: str,
+                   seeds: Union[str, List[int]] = None,
+                   radius: float = 12.0,
+                   selection: str = None,
+                   output_file: str = None,
+                   prefix: str = None,
+                   model_name: str = "(all)",
+                   distance_threshold: float = 4.0) -> PatchList:
+    """
+    Grow geodesic patches around seed vertices,
+    see `geodesic_patches`.
+
+    Parameters
+    ----------
+    ply_file : str
+        Mesh file.
+
+    seeds : str or List[int]
+        Seed vertex indices, such as "10,52,301".
+
+    radius : float
+        Geodesic radius of patches.
+
+    selection : str
+        Use the nearest vertex of each atom in
+        selection as seeds, instead of `seeds`.
+
+    output_file : str
+        If given, save patches as CSR `.npz` patch list,
+        usable by `load_ply_with_patch`.
+
+    prefix : str
+        If given, copy residues of each patch from
+        `model_name` to object `{prefix}{seed}`, as
+        `extract_patches`.
+
+    distance_threshold : float
+        The threshold of distance to defined patch residue.
+
+    Returns
+    ----------
+    Patch list of seeds.
+    """
+    if (seeds is None) == (selection is None):
+        raise ValueError("Please specific one of seeds and selection!")
+    mesh = Mesh.read(ply_file)
+    if selection is not None:
+        seed_atoms = get_atom_table(selection, fields=('index',), coords=True)
+        _, seeds = nearest_vertices(mesh.vertices, seed_atoms['coord'])
+        seeds = np.unique(seeds)
+    else:
+        seeds = _parse_ids(seeds)
+
+    patches = geodesic_patches(mesh, seeds, float(radius))
+    if output_file:
+        patches.save(output_file)
+
+    if prefix is not None:
+        atoms = get_atom_table(model_name, coords=True)
+        atoms_tree = cKDTree(atoms['coord'])
+        patch_atoms = [
+            atoms_near_vertices(atoms_tree, mesh.vertices[patches[seed]], float(distance_threshold))
+            for seed in patches.ids.tolist()]
+        _create_patch_objects(
+            [f"{prefix}{seed}" for seed in patches.ids.tolist()], atoms, patch_atoms)
+    return patches
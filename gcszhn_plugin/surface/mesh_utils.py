@@ -1,14 +1,231 @@
-from typing import Iterable
+from typing import Dict, FrozenSet, Iterable, Sequence, Union
+import os
+import re
+import struct
+import hashlib
+import logging
+import zipfile
+import tempfile
+import threading
 import numpy as np
+from ..utils import cmd
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from scipy.sparse import csr_matrix
+from ..utils import register_pymol_cmd, as_bool
+
+# parsed meshes are cached in a user cache directory,
+# never next to the (possibly read-only or shared) input files.
+# Least recently used files are removed above `max_size` MB.
+MESH_CACHE = {
+    'enabled': os.environ.get('GCSZHN_MESH_CACHE', '1') != '0',
+    'cache_dir': os.environ.get('GCSZHN_MESH_CACHE_DIR') or None,
+    'max_size': float(os.environ.get('GCSZHN_MESH_CACHE_MAX_MB', 2048)),
+}
+
+
+def default_cache_dir() -> str:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'gcszhn_plugin', 'meshes')
+
+
+def load_npz(filename: str, mmap_mode: str = None) -> Dict[str, np.ndarray]:
+    """
+    Load all arrays of a `.npz` archive. Arrays stored
+    without compression (as `np.savez` does) are memory
+    mapped when `mmap_mode` is given.
+    """
+    arrays = dict()
+    with zipfile.ZipFile(filename) as archive, open(filename, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if mmap_mode is None or info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member, allow_pickle=False)
+                continue
+            # locate array data right after the local file header and npy header
+            f.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError(f"Object array {name} in {filename} can not be memory mapped")
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    filename, dtype=dtype, mode=mmap_mode, offset=f.tell(),
+                    shape=shape, order='F' if fortran_order else 'C')
+    return arrays
+
+
+def readonly(array) -> np.ndarray:
+    """
+    Read-only view of array, without copying data.
+    """
+    view = np.asarray(array).view()
+    view.flags.writeable = False
+    return view
+
+
+def compute_vertex_normals(vertices: np.ndarray, faces: np.ndarray) -> np.ndarray:
+    """
+    Area-weighted unit vertex normals of a triangle mesh.
+    Face normals follow the winding order of `faces`.
+    Vertices without face get zero normal.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    v0, v1, v2 = (vertices[faces[:, i]] for i in range(3))
+    # norm of cross product is twice the face area
+    face_normals = np.cross(v1 - v0, v2 - v0)
+    # scatter-add face normal to x, y, z of its three corners in one pass
+    targets = (faces[:, :, None] * 3 + np.arange(3)).ravel()
+    weights = np.broadcast_to(face_normals[:, None, :], (len(faces), 3, 3)).ravel()
+    normals = np.bincount(
+        targets, weights=weights, minlength=3 * len(vertices)).reshape(-1, 3)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    np.divide(normals, lengths, out=normals, where=lengths > 0)
+    return normals
+
+
+def build_adjacency(vertices: np.ndarray, faces: np.ndarray) -> csr_matrix:
+    """
+    Symmetric CSR adjacency of triangle mesh vertices,
+    weighted by Euclidean edge length.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    lengths = np.linalg.norm(vertices[edges[:, 0]] - vertices[edges[:, 1]], axis=1)
+    # keep edges of coincident vertices, zero weight means no edge
+    lengths = np.maximum(lengths, np.finfo(np.float64).tiny)
+    rows = np.concatenate([edges[:, 0], edges[:, 1]])
+    cols = np.concatenate([edges[:, 1], edges[:, 0]])
+    return csr_matrix(
+        (np.concatenate([lengths, lengths]), (rows, cols)),
+        shape=(len(vertices), len(vertices)))
+
+
+# numpy dtype of PLY property types
+PLY_TYPES = {
+    'char': 'i1', 'uchar': 'u1', 'short': 'i2', 'ushort': 'u2',
+    'int': 'i4', 'uint': 'u4', 'float': 'f4', 'double': 'f8',
+    'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2',
+    'int32': 'i4', 'uint32': 'u4', 'float32': 'f4', 'float64': 'f8'}
+_PLY_NAMES = {
+    'i1': 'char', 'u1': 'uchar', 'i2': 'short', 'u2': 'ushort',
+    'i4': 'int', 'u4': 'uint', 'f4': 'float', 'f8': 'double'}
+
+
+def read_ply_header(f) -> dict:
+    """
+    Parse PLY header from binary file object, leaving
+    it at the start of data.
+
+    Returns
+    ----------
+    Dict with "format" and "elements", a list of (name, count,
+    properties). Each property is (name, dtype) or, for list
+    properties, (name, (count dtype, item dtype)).
+    """
+    if f.readline().strip() != b'ply':
+        raise ValueError("Not a PLY file")
+    header = {'format': None, 'elements': []}
+    for line in iter(f.readline, b''):
+        fields = line.decode('ascii').split()
+        if not fields or fields[0] in ('comment', 'obj_info'):
+            continue
+        if fields[0] == 'end_header':
+            return header
+        if fields[0] == 'format':
+            header['format'] = fields[1]
+        elif fields[0] == 'element':
+            header['elements'].append((fields[1], int(fields[2]), []))
+        elif fields[0] == 'property' and fields[1] == 'list':
+            header['elements'][-1][2].append(
+                (fields[4], (PLY_TYPES[fields[2]], PLY_TYPES[fields[3]])))
+        elif fields[0] == 'property':
+            header['elements'][-1][2].append((fields[2], PLY_TYPES[fields[1]]))
+    raise ValueError("PLY header without end_header")
+
+
+def _ply_dtype(array: np.ndarray) -> np.dtype:
+    dtype = np.asarray(array).dtype
+    if dtype == np.bool_:
+        return np.dtype('u1')
+    if dtype.kind in 'iu' and dtype.itemsize > 4:
+        return np.dtype(dtype.kind + '4')
+    if dtype.kind == 'f' and dtype.itemsize < 4:
+        return np.dtype('f4')
+    if dtype.str[1:] not in _PLY_NAMES:
+        return np.dtype('f8')
+    return dtype.newbyteorder('<')
+
+
+def write_ply(filename: str, vertices: np.ndarray, faces: np.ndarray, attributes: Dict[str, np.ndarray] = None):
+    """
+    Write triangle mesh as binary little-endian PLY,
+    with one bulk write of each element block. Float
+    vertices keep their precision (`float` or `double`).
+
+    Parameters
+    ----------
+    attributes: Dict[str, np.ndarray]
+        Attributes named `vertex_*` or `face_*`,
+        written as properties of vertex or face element.
+    """
+    vertices = np.asarray(vertices)
+    faces = np.asarray(faces).reshape(-1, 3)
+    attributes = attributes or dict()
+    vertex_dtype = _ply_dtype(vertices) if vertices.dtype.kind == 'f' else np.dtype('<f4')
+    vertex_columns = [(axis, vertices[:, i], vertex_dtype) for i, axis in enumerate('xyz')]
+    face_columns = []
+    for name, values in attributes.items():
+        if name in ('vertex_x', 'vertex_y', 'vertex_z'):
+            continue
+        if name.startswith('vertex_'):
+            vertex_columns.append((name[7:], values, _ply_dtype(values)))
+        elif name.startswith('face_'):
+            face_columns.append((name[5:], values, _ply_dtype(values)))
+
+    vertex_block = np.empty(len(vertices), dtype=[(n, d) for n, _, d in vertex_columns])
+    for name, values, _ in vertex_columns:
+        vertex_block[name] = values
+    face_block = np.empty(len(faces), dtype=[
+        ('count', 'u1'), ('vertex_indices', '<i4', (3,))] + [(n, d) for n, _, d in face_columns])
+    face_block['count'] = 3
+    face_block['vertex_indices'] = faces
+    for name, values, _ in face_columns:
+        face_block[name] = values
+
+    header = ['ply', 'format binary_little_endian 1.0', f'element vertex {len(vertices)}']
+    header += [f'property {_PLY_NAMES[d.str[1:]]} {n}' for n, _, d in vertex_columns]
+    header += [f'element face {len(faces)}', 'property list uchar int vertex_indices']
+    header += [f'property {_PLY_NAMES[d.str[1:]]} {n}' for n, _, d in face_columns]
+    header.append('end_header\n')
+    with open(filename, 'wb') as f:
+        f.write('\n'.join(header).encode('ascii'))
+        vertex_block.tofile(f)
+        face_block.tofile(f)
 
 
 class Mesh(metaclass=ABCMeta):
     """Abstract base class for mesh objects."""
 
+    NORMAL_ATTRIBUTES = ('vertex_nx', 'vertex_ny', 'vertex_nz')
+
     def __init__(self):
         self.vertices = None
         self.faces = None
+        self._attribute_names = None
+        self._packed = dict()
+        self._adjacency = None
 
     @abstractmethod
     def load_mesh(self, filename: str):
@@ -22,9 +239,85 @@ class Mesh(metaclass=ABCMeta):
     
     @abstractmethod
     def get_attribute(self, attribute_name: str) -> np.ndarray:
-        """Return a copy of the attribute."""
+        """Return a read-only view of the attribute."""
         raise NotImplementedError
+
+    @abstractmethod
+    def _store_attribute(self, attribute_name: str, values: np.ndarray):
+        """Store attribute in the underlying mesh."""
+        raise NotImplementedError
+
+    def set_attribute(self, attribute_name: str, values: np.ndarray):
+        """
+        Add or replace a `vertex_` or `face_` attribute.
+        """
+        values = np.asarray(values)
+        if attribute_name.startswith('vertex_'):
+            size = len(self.vertices)
+        elif attribute_name.startswith('face_'):
+            size = len(self.faces)
+        else:
+            raise ValueError(f"Attribute name must start with vertex_ or face_: {attribute_name}")
+        if len(values) != size:
+            raise ValueError(f"{len(values)} values for {size} items of {attribute_name}")
+        self._store_attribute(attribute_name, values)
+        self._attribute_names = None
+        self._packed = {k: v for k, v in self._packed.items() if attribute_name not in k}
+
+    @property
+    def attribute_names(self) -> FrozenSet[str]:
+        """Set of attribute names, for membership tests."""
+        if self._attribute_names is None:
+            self._attribute_names = frozenset(self.get_attribute_names())
+        return self._attribute_names
+
+    def get_attributes(self, attribute_names: Sequence[str]) -> np.ndarray:
+        """
+        Pack attributes as columns of one read-only (N, k)
+        array. It is built once and shared by later calls.
+        """
+        key = tuple(attribute_names)
+        if key not in self._packed:
+            self._packed[key] = readonly(np.column_stack(
+                [self.get_attribute(name) for name in key]))
+        return self._packed[key]
+
+    @property
+    def normals(self) -> np.ndarray:
+        """
+        Packed (N, 3) vertex normals. Meshes without
+        normal attributes get area-weighted normals computed
+        from faces once, None if there is no face.
+        """
+        if self.attribute_names.issuperset(self.NORMAL_ATTRIBUTES):
+            return self.get_attributes(self.NORMAL_ATTRIBUTES)
+        if self.NORMAL_ATTRIBUTES not in self._packed:
+            if self.faces is None or len(self.faces) == 0:
+                return None
+            self._packed[self.NORMAL_ATTRIBUTES] = readonly(
+                compute_vertex_normals(self.vertices, self.faces))
+        return self._packed[self.NORMAL_ATTRIBUTES]
     
+    @property
+    def adjacency(self) -> csr_matrix:
+        """
+        Symmetric (N, N) CSR vertex graph weighted by
+        edge length, built from faces once.
+        """
+        if self._adjacency is None:
+            self._adjacency = build_adjacency(self.vertices, self.faces)
+        return self._adjacency
+
+    def save_ply(self, filename: str, attribute_names: Sequence[str] = None):
+        """
+        Save mesh with attributes (all by default) as
+        binary little-endian PLY, see `write_ply`.
+        """
+        if attribute_names is None:
+            attribute_names = self.get_attribute_names()
+        write_ply(filename, self.vertices, self.faces, {
+            name: self.get_attribute(name) for name in attribute_names})
+
     @staticmethod
     def create_mesh():
         if MESHIO_AVAILABLE:
@@ -34,6 +327,28 @@ class Mesh(metaclass=ABCMeta):
         else:
             return SimpleMesh()
 
+    @staticmethod
+    def read(filename: str, use_cache: bool = None) -> 'Mesh':
+        """
+        Load mesh by `create_mesh()`. Parsed arrays are
+        saved to a `.npz` cache and memory mapped next
+        time, see `set_mesh_cache`.
+        """
+        if use_cache is None:
+            use_cache = MESH_CACHE['enabled']
+        if use_cache:
+            mesh = _load_cached_mesh(filename)
+            if mesh is not None:
+                return mesh
+        mesh = Mesh.create_mesh()
+        mesh.load_mesh(filename)
+        if use_cache:
+            try:
+                _save_cached_mesh(filename, mesh)
+            except OSError as e:
+                logging.warning(f'failed to write mesh cache of {filename}: {e}')
+        return mesh
+
 
 try:
     import meshio
@@ -62,10 +377,16 @@ try:
         def get_attribute(self, attribute_name: str)-> np.ndarray:
             if attribute_name.startswith('vertex_'):
                 attribute_name = attribute_name[7:]
-                return np.copy(self.mesh.point_data[attribute_name])
+                return readonly(self.mesh.point_data[attribute_name])
             elif attribute_name.startswith('face_'):
                 attribute_name = attribute_name[5:]
-                return np.copy(self.mesh.cell_data['triangle'][attribute_name])
+                return readonly(self.mesh.cell_data['triangle'][attribute_name])
+
+        def _store_attribute(self, attribute_name: str, values: np.ndarray):
+            if attribute_name.startswith('vertex_'):
+                self.mesh.point_data[attribute_name[7:]] = values
+            else:
+                self.mesh.cell_data.setdefault('triangle', {})[attribute_name[5:]] = values
 
 except ImportError:
     MESHIO_AVAILABLE = False
@@ -89,7 +410,12 @@ try:
             return self.mesh.get_attribute_names()
 
         def get_attribute(self, attribute_name: str)-> np.ndarray:
-            return np.copy(self.mesh.get_attribute(attribute_name))
+            return readonly(self.mesh.get_attribute(attribute_name))
+
+        def _store_attribute(self, attribute_name: str, values: np.ndarray):
+            if not self.mesh.has_attribute(attribute_name):
+                self.mesh.add_attribute(attribute_name)
+            self.mesh.set_attribute(attribute_name, values)
 except ImportError:
     PYMESH_AVAILABLE = False
 
@@ -103,9 +429,15 @@ class SimpleMesh(Mesh):
         self.faces = []
 
     def load_mesh(self, filename: str):
+        with open(filename, 'rb') as f:
+            header = read_ply_header(f)
+            if header['format'] == 'binary_little_endian':
+                return self._load_binary(f, header)
+            elif header['format'] != 'ascii':
+                raise ValueError(f"Unsupported PLY format {header['format']}")
         lines = open(filename, 'r').readlines()
         # Read header
-        self.attribute_names = []
+        self.property_names = []
         self.num_verts = 0
         line_ix = 0
         while 'end_header' not in lines[line_ix]: 
@@ -113,17 +445,16 @@ class SimpleMesh(Mesh):
             if line.startswith('element vertex'): 
                 self.num_verts = int(line.split(' ')[2])
             if line.startswith('property float') or line.startswith('property double'):
-                self.attribute_names.append('vertex_'+line.split(' ')[2].rstrip())
+                self.property_names.append('vertex_'+line.split(' ')[2].rstrip())
             if line.startswith('element face'):
                 self.num_faces= int(line.split(' ')[2])
             line_ix += 1
         line_ix += 1
         header_lines = line_ix
         self.attributes = {}
-        for at in self.attribute_names:
+        for at in self.property_names:
             self.attributes[at] = []
         self.vertices = []
-        self.normals = []
         self.faces = []
         # Read vertex attributes.
         for i in range(header_lines, self.num_verts+header_lines):
@@ -131,7 +462,7 @@ class SimpleMesh(Mesh):
             vert_att = [float(x) for x in cur_line]
             # Organize by attributes
             for jj, att in enumerate(vert_att): 
-                self.attributes[self.attribute_names[jj]].append(att)
+                self.attributes[self.property_names[jj]].append(att)
             line_ix += 1
         # Set up vertices
         for jj in range(len(self.attributes['vertex_x'])):
@@ -154,9 +485,300 @@ class SimpleMesh(Mesh):
         for key in self.attributes.keys():
             self.attributes[key] = np.array(self.attributes[key])
 
+    def _load_binary(self, f, header: dict):
+        self.property_names = []
+        self.attributes = {}
+        self.faces = np.zeros((0, 3), dtype=np.int32)
+        for element, count, properties in header['elements']:
+            dtype = []
+            for name, prop_dtype in properties:
+                if isinstance(prop_dtype, tuple):
+                    # only fixed size lists of triangle faces
+                    dtype += [(name + '_count', '<' + prop_dtype[0]), (name, '<' + prop_dtype[1], (3,))]
+                else:
+                    dtype.append((name, '<' + prop_dtype))
+            block = np.fromfile(f, dtype=dtype, count=count)
+            if len(block) != count:
+                raise ValueError(f"Truncated PLY {element} element")
+            for name, prop_dtype in properties:
+                if isinstance(prop_dtype, tuple):
+                    if element != 'face' or np.any(block[name + '_count'] != 3):
+                        raise ValueError("Only triangle faces are supported")
+                    self.faces = np.ascontiguousarray(block[name])
+                elif element in ('vertex', 'face'):
+                    key = f'{element}_{name}'
+                    self.property_names.append(key)
+                    self.attributes[key] = np.ascontiguousarray(block[name])
+        self.num_verts = len(self.attributes['vertex_x'])
+        self.num_faces = len(self.faces)
+        self.vertices = np.column_stack([
+            self.attributes['vertex_x'],
+            self.attributes['vertex_y'],
+            self.attributes['vertex_z']]).astype(np.float64)
+
     def get_attribute_names(self) -> Iterable[str]:
-        for key in self.attribute_names:
+        for key in self.property_names:
             yield key
 
     def get_attribute(self, attribute_name: str) -> np.ndarray:
-        return np.copy(self.attributes[attribute_name])
+        return readonly(self.attributes[attribute_name])
+
+    def _store_attribute(self, attribute_name: str, values: np.ndarray):
+        if attribute_name not in self.attributes:
+            self.property_names.append(attribute_name)
+        self.attributes[attribute_name] = values
+
+
+class ArrayMesh(Mesh):
+    """
+    Mesh backed by arrays, such as memory mapped
+    arrays of a sidecar cache."""
+
+    def __init__(self, vertices=None, faces=None, attributes=None):
+        super().__init__()
+        self.vertices = vertices
+        self.faces = faces
+        self.attributes = dict(attributes or {})
+        self.metadata = dict()
+
+    def load_mesh(self, filename: str):
+        arrays = load_npz(filename, mmap_mode='r')
+        self.vertices = arrays['vertices']
+        self.faces = arrays['faces']
+        self.attributes = {
+            k: v for k, v in arrays.items()
+            if k.startswith('vertex_') or k.startswith('face_')}
+        self.metadata = {
+            k: v.item() for k, v in arrays.items() if k.startswith('source_')}
+
+    def get_attribute_names(self) -> Iterable[str]:
+        for key in self.attributes:
+            yield key
+
+    def get_attribute(self, attribute_name: str) -> np.ndarray:
+        return readonly(self.attributes[attribute_name])
+
+    def _store_attribute(self, attribute_name: str, values: np.ndarray):
+        self.attributes[attribute_name] = values
+
+
+def _file_hash(filename: str) -> str:
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def _cache_dir() -> str:
+    return MESH_CACHE['cache_dir'] or default_cache_dir()
+
+
+def _cache_path(filename: str) -> str:
+    cache_dir = _cache_dir()
+    path_hash = hashlib.blake2b(
+        os.path.abspath(filename).encode(), digest_size=8).hexdigest()
+    return os.path.join(cache_dir, f'{path_hash}_{os.path.basename(filename)}.npz')
+
+
+def _load_cached_mesh(filename: str) -> Mesh:
+    cache_file = _cache_path(filename)
+    if not os.path.exists(cache_file):
+        return None
+    stat = os.stat(filename)
+    try:
+        mesh = ArrayMesh()
+        mesh.load_mesh(cache_file)
+        meta = mesh.metadata
+        source_size, source_mtime, source_hash = (
+            meta['source_size'], meta['source_mtime'], meta['source_hash'])
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        logging.warning(f'ignore invalid mesh cache {cache_file}: {e}')
+        return None
+    if source_size != stat.st_size:
+        return None
+    if source_mtime != stat.st_mtime_ns:
+        # a touched or copied file is still valid if content unchanged,
+        # save its new mtime so it is not hashed again next time
+        file_hash = _file_hash(filename)
+        if source_hash != file_hash:
+            return None
+        try:
+            _save_cached_mesh(filename, mesh, file_hash)
+        except OSError as e:
+            logging.warning(f'failed to write mesh cache of {filename}: {e}')
+    else:
+        # mtime of cache file orders eviction, see `_evict_cached_meshes`
+        try:
+            os.utime(cache_file)
+        except OSError:
+            pass
+    return mesh
+
+
+def _save_cached_mesh(filename: str, mesh: Mesh, source_hash: str = None):
+    cache_file = _cache_path(filename)
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    stat = os.stat(filename)
+    arrays = {
+        name: np.asarray(mesh.get_attribute(name))
+        for name in mesh.get_attribute_names()}
+    arrays.update(
+        vertices=np.asarray(mesh.vertices),
+        faces=np.asarray(mesh.faces),
+        source_size=np.array(stat.st_size),
+        source_mtime=np.array(stat.st_mtime_ns),
+        source_hash=np.array(source_hash or _file_hash(filename)))
+    # unique temporary file, the same mesh may be cached by several threads
+    with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(cache_file)),
+            suffix='.tmp', delete=False) as f:
+        try:
+            np.savez(f, **arrays)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, cache_file)
+    _evict_cached_meshes(MESH_CACHE['max_size'] * 2 ** 20)
+
+
+_CACHE_FILE_PATTERN = re.compile(r'^[0-9a-f]{16}_.+\.npz$')
+
+
+def _cached_mesh_files(cache_dir: str) -> list:
+    # only files named by `_cache_path`, the cache directory
+    # may be shared with other files.
+    if not os.path.isdir(cache_dir):
+        return []
+    files = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and _CACHE_FILE_PATTERN.match(entry.name):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    return files
+
+
+def _evict_cached_meshes(max_bytes: float, cache_dir: str = None) -> int:
+    """
+    Remove least recently used cache files until their
+    total size is at most `max_bytes`. Return number of
+    removed bytes.
+    """
+    files = sorted(_cached_mesh_files(cache_dir or _cache_dir()))
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for _, size, path in files:
+        if total - removed <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError as e:
+            # such as a file memory mapped on Windows
+            logging.warning(f'failed to remove mesh cache {path}: {e}')
+            continue
+        removed += size
+    return removed
+
+
+@register_pymol_cmd
+def set_mesh_cache(enabled: bool = True, cache_dir: str = None, max_size: float = None):
+    """
+    Configure cache of parsed mesh files.
+
+    Parameters
+    ----------
+    enabled: bool or str
+        Whether to write and reuse the cache. "clear"
+        removes all cache files and keeps the setting.
+    cache_dir: str
+        Directory of cache files. By default cache is
+        saved in `$XDG_CACHE_HOME/gcszhn_plugin/meshes`
+        (`~/.cache` if not set).
+    max_size: float
+        Maximum total size of cache files in MB, least
+        recently used files are removed above it.
+    """
+    if str(enabled).lower() == 'clear':
+        cache_dir = cache_dir or _cache_dir()
+        removed = _evict_cached_meshes(0, cache_dir)
+        print(f"removed {removed / 2 ** 20:.1f} MB of mesh cache in {cache_dir}")
+        return
+    MESH_CACHE['enabled'] = as_bool(enabled)
+    MESH_CACHE['cache_dir'] = cache_dir or None
+    if max_size is not None:
+        MESH_CACHE['max_size'] = float(max_size)
+    _evict_cached_meshes(MESH_CACHE['max_size'] * 2 ** 20)
+
+
+# meshes loaded by object name, for commands working on them later,
+# least recently used first. Files are kept by name only, at most
+# `MAX_LOADED_MESHES` computed meshes are kept in memory.
+__loaded_meshes__: Dict[str, Union[Mesh, str]] = OrderedDict()
+MAX_LOADED_MESHES = 8
+_loaded_meshes_lock = threading.Lock()
+# names registered without a pymol object, never dropped by `get_mesh`
+_kept_meshes = set()
+
+
+def register_mesh(name: str, mesh: Union[Mesh, str], keep: bool = False):
+    """
+    Register loaded mesh by object name. Register the
+    mesh file for meshes read from file, so the mesh
+    is read again instead of kept in memory. Meshes
+    registered with `keep` are kept even if no object
+    has the name, such as meshes that are not loaded.
+    """
+    with _loaded_meshes_lock:
+        __loaded_meshes__[name] = mesh
+        __loaded_meshes__.move_to_end(name)
+        if keep:
+            _kept_meshes.add(name)
+        else:
+            _kept_meshes.discard(name)
+        in_memory = [k for k, v in __loaded_meshes__.items() if not isinstance(v, str)]
+        for k in in_memory[:-MAX_LOADED_MESHES]:
+            del __loaded_meshes__[k]
+            _kept_meshes.discard(k)
+
+
+def get_mesh(name: str) -> Mesh:
+    """
+    Mesh registered as `name`, or read from file `name`.
+    Meshes of objects deleted from pymol are dropped,
+    unless registered with `keep`.
+    """
+    with _loaded_meshes_lock:
+        names = set(cmd.get_names('all')) | _kept_meshes
+        for k in [k for k in __loaded_meshes__ if k not in names]:
+            del __loaded_meshes__[k]
+        mesh = __loaded_meshes__.get(name, name)
+        if name in __loaded_meshes__:
+            __loaded_meshes__.move_to_end(name)
+    if isinstance(mesh, str):
+        if not os.path.exists(mesh):
+            raise KeyError(f"Undefined mesh {name}")
+        mesh = Mesh.read(mesh)
+    return mesh
+
+
+@register_pymol_cmd
+def save_ply(name: str, filename: str, attributes: str = None):
+    """
+    Save mesh as binary little-endian PLY.
+
+    Parameters
+    ----------
+    name: str
+        Object name of a loaded mesh (such as the group
+        of `load_ply`), or a mesh file to convert.
+    filename: str
+        Output PLY file.
+    attributes: str
+        Comma separated attribute names to save,
+        such as "vertex_charge,vertex_hphob".
+        All attributes are saved by default.
+    """
+    if isinstance(attributes, str):
+        attributes = [a.strip() for a in attributes.split(',') if a.strip()]
+    get_mesh(name).save_ply(filename, attributes)
@@ -1,11 +1,28 @@
+import os
+import glob
+import itertools
 import numpy as np
+import pandas as pd
 
-from pymol import cmd
-from scipy.spatial.distance import cdist
-from .mesh_utils import Mesh
-from ..utils import register_pymol_cmd
+from ..utils import cmd
+from typing import List, Sequence, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import cKDTree
+from .mesh_utils import Mesh, load_npz
+from ..utils import (
+    register_pymol_cmd,
+    count_items,
+    get_atom_table,
+    select_indices,
+    local_setting,
+    on_cmd_thread,
+    report_progress,
+    submit_job,
+    RESIDUE_FIELDS)
 
-__all__ = ['extract_patch']
+__all__ = [
+    'extract_patch', 'extract_patch_async', 'extract_patches',
+    'convert_patch_list', 'PatchList']
 
 # 三字母氨基酸缩写和单字母缩写的对应关系，字典
 # https://www.bioinformatics.org/sms/iupac.html
@@ -33,6 +50,151 @@ amino_code = {
 }
 
 
+class PatchList:
+    """
+    Patch list in compressed sparse row (CSR) layout.
+    Vertices of the i-th patch are
+    `indices[indptr[i]:indptr[i + 1]]` and its patch id
+    is `ids[i]`, which is the first (center) vertex
+    in MaSIF pickled patch lists, or -1 for an empty patch.
+    """
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, ids: np.ndarray = None):
+        self.indptr = indptr
+        self.indices = indices
+        if ids is None:
+            # empty patches repeat an offset, so they have no first vertex
+            lengths = np.diff(indptr)
+            ids = np.full(len(lengths), -1, dtype=np.int64)
+            ids[lengths > 0] = indices[indptr[:-1][lengths > 0]]
+        self.ids = ids
+        self._sorted_ids = None
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def __getitem__(self, patch_id) -> np.ndarray:
+        row = self.rows([patch_id])[0]
+        return self.indices[self.indptr[row]:self.indptr[row + 1]]
+
+    @classmethod
+    def from_object_array(cls, patch_list: Sequence[Sequence[int]]) -> 'PatchList':
+        """
+        Build from a sequence of vertex index arrays,
+        such as the pickled MaSIF patch list.
+        """
+        lengths = np.fromiter(
+            (len(patch) for patch in patch_list), dtype=np.int64, count=len(patch_list))
+        indptr = np.zeros(len(patch_list) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        if len(patch_list):
+            indices = np.concatenate(
+                [np.asarray(patch, dtype=np.int32) for patch in patch_list])
+        else:
+            indices = np.zeros(0, dtype=np.int32)
+        return cls(indptr, indices)
+
+    @classmethod
+    def load(cls, filename: str, mmap_mode: str = 'r') -> 'PatchList':
+        """
+        Load patch list from CSR `.npz` file (memory mapped),
+        or legacy pickled object array `.npy` file.
+        """
+        if filename.endswith('.npz'):
+            return cls(**load_npz(filename, mmap_mode=mmap_mode))
+        return cls.from_object_array(np.load(filename, allow_pickle=True))
+
+    def save(self, filename: str):
+        """
+        Save as uncompressed CSR `.npz` file,
+        which can be memory mapped by `PatchList.load`.
+        """
+        np.savez(filename, indptr=self.indptr, indices=self.indices, ids=self.ids)
+
+    def rows(self, patch_ids: Sequence[int]) -> np.ndarray:
+        """
+        Row numbers of given patch ids.
+        """
+        if self._sorted_ids is None:
+            order = np.argsort(self.ids, kind='stable')
+            self._sorted_ids = (order, np.asarray(self.ids)[order])
+        order, sorted_ids = self._sorted_ids
+        patch_ids = np.asarray(patch_ids, dtype=sorted_ids.dtype)
+        pos = np.searchsorted(sorted_ids, patch_ids)
+        pos = np.minimum(pos, len(sorted_ids) - 1)
+        missing = (len(sorted_ids) == 0) | (sorted_ids[pos] != patch_ids)
+        if np.any(missing):
+            raise KeyError(f"Undefined patch id {patch_ids[missing].tolist()}")
+        return order[pos]
+
+    def gather(self, patch_ids: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Gather vertices of many patches at once,
+        in O(total patch vertices).
+
+        Returns
+        ----------
+        Vertex indices of all patches, and the position
+        in `patch_ids` each vertex belongs to.
+        """
+        rows = self.rows(patch_ids)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        owners = np.repeat(np.arange(len(rows)), lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return self.indices[starts[owners] + offsets], owners
+
+
+@register_pymol_cmd
+def convert_patch_list(patch_list_file: str, output_file: str = None):
+    """
+    Convert pickled MaSIF patch list (`.npy` object array)
+    to compact CSR `.npz` format.
+
+    Parameters
+    ----------
+    patch_list_file : str
+        Pickled patch list file.
+
+    output_file : str
+        Output `.npz` file. Default is the input file
+        with `.npz` suffix.
+    """
+    if not output_file:
+        output_file = os.path.splitext(patch_list_file)[0] + '.npz'
+    PatchList.load(patch_list_file).save(output_file)
+
+
+def atoms_near_vertices(
+        atoms_tree: cKDTree,
+        vertices: np.ndarray,
+        distance_threshold: float) -> np.ndarray:
+    """
+    Find atoms closer than `distance_threshold`
+    to any of vertices.
+
+    Parameters
+    ----------
+    atoms_tree : cKDTree
+        KD-tree of atom coordinates.
+
+    vertices : np.ndarray
+        Vertices of patch mesh.
+
+    distance_threshold : float
+        The threshold of distance, exclusive.
+
+    Returns
+    ----------
+    Sorted row indices of selected atoms in `atoms_tree`.
+    """
+    # query_ball_point is inclusive, shrink radius by one ulp
+    radius = np.nextafter(distance_threshold, 0)
+    neighbors = atoms_tree.query_ball_point(vertices, radius, return_sorted=False)
+    return np.unique(np.fromiter(
+        itertools.chain.from_iterable(neighbors), dtype=np.int64))
+
+
 @register_pymol_cmd
 def extract_patch(patch_name:str, 
                   patch_ply_name:str,
@@ -60,19 +222,153 @@ def extract_patch(patch_name:str,
     distance_threshold: float
         The threshold of distance to defined patch residue.
     """
-    atoms_coords = np.array([atom.coord for atom in cmd.get_model(model_name).atom])
-    atoms_ids = np.array([atom.id for atom in cmd.get_model(model_name).atom])
-    mesh = Mesh.create_mesh()
-    mesh.load_mesh(patch_ply_name)
-    atoms_dists = cdist(atoms_coords, mesh.vertices).min(axis=1)
-    atoms_selected = atoms_ids[atoms_dists < distance_threshold]
-    ids_selected = ",".join([str(i) for i in atoms_selected])
-    if model_name == "(all)":
-        cmd.select("selected_atoms", f"id " + ids_selected)
-    else:
-        cmd.select("selected_atoms", f"model {model_name} and id {ids_selected}")
-    cmd.extract(patch_name, "selected_atoms")
-    if remove_model:
-        cmd.delete(model_name)
-    cmd.delete("selected_atoms")
+    atoms = get_atom_table(model_name, coords=True)
+    report_progress(1, 3, 'load mesh')
+    mesh = Mesh.read(patch_ply_name)
+    report_progress(2, 3, 'query atoms')
+    count_items(len(atoms['coord']) + len(mesh.vertices))
+    atoms_selected = atoms_near_vertices(
+        cKDTree(atoms['coord']), mesh.vertices, float(distance_threshold))
+    report_progress(3, 3, 'extract atoms')
+    _extract_atoms(
+        patch_name,
+        atoms['model'][atoms_selected],
+        atoms['index'][atoms_selected],
+        model_name if remove_model else None)
+
+
+@on_cmd_thread
+def _extract_atoms(patch_name: str, models: np.ndarray, indices: np.ndarray, remove_model_name: str = None):
+    try:
+        select_indices("selected_atoms", models, indices)
+        cmd.extract(patch_name, "selected_atoms")
+    finally:
+        cmd.delete("selected_atoms")
+    if remove_model_name:
+        cmd.delete(remove_model_name)
+
 
+@register_pymol_cmd
+def extract_patch_async(patch_name:str,
+                        patch_ply_name:str,
+                        model_name: str = "(all)",
+                        remove_model: bool = False,
+                        distance_threshold: float = 4.0) -> int:
+    """
+    Run `extract_patch` as background job,
+    see `plugin_jobs` and `cancel_plugin_job`.
+    """
+    return submit_job(
+        'extract_patch', extract_patch,
+        patch_name, patch_ply_name, model_name, remove_model, distance_threshold).id
+
+
+
+@register_pymol_cmd
+def extract_patches(patch_ply_files: Union[str, List[str]],
+                    model_name: str = "(all)",
+                    prefix: str = "",
+                    remove_model: bool = False,
+                    distance_threshold: float = 4.0,
+                    threads: int = 0,
+                    output: str = "objects"):
+    """
+    Extract residues of many patches from model
+    against one atom KD-tree. Unlike `extract_patch`,
+    atoms are copied, so patches can overlap.
+
+    Parameters
+    ----------
+    patch_ply_files : str or List[str]
+        Glob pattern or list of patch mesh files.
+
+    model_name: str
+        Name of the specific model.
+
+    prefix: str
+        Prefix of patch object names, followed
+        by the patch file name without suffix.
+
+    remove_model: bool
+        If True, remove model after patch extracted.
+
+    distance_threshold: float
+        The threshold of distance to defined patch residue.
+
+    threads: int
+        Number of threads to query patches, 0 or 1
+        for serial query.
+
+    output: str
+        "objects" to create patch objects,
+        "table" to return residue membership table.
+
+    Returns
+    ----------
+    Residue membership table if output is "table".
+    """
+    if output not in ("objects", "table"):
+        raise ValueError(f"Unknown output: {output}")
+    if isinstance(patch_ply_files, str):
+        pattern = patch_ply_files
+        patch_ply_files = sorted(glob.glob(pattern))
+        if not patch_ply_files:
+            raise ValueError(f"No files match {pattern}")
+    patch_names = [
+        prefix + os.path.splitext(os.path.basename(f))[0] for f in patch_ply_files]
+
+    atoms = get_atom_table(
+        model_name,
+        fields=('index',) + RESIDUE_FIELDS,
+        coords=True)
+    atoms_tree = cKDTree(atoms['coord'])
+
+    def _query(patch_ply_name):
+        mesh = Mesh.read(patch_ply_name)
+        count_items(len(mesh.vertices))
+        return atoms_near_vertices(atoms_tree, mesh.vertices, float(distance_threshold))
+
+    threads = int(threads)
+    pool = ThreadPoolExecutor(threads) if threads > 1 else None
+    patch_atoms = []
+    try:
+        for rows in (pool.map if pool else map)(_query, patch_ply_files):
+            patch_atoms.append(rows)
+            report_progress(len(patch_atoms), len(patch_ply_files), 'query patches')
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    count_items(len(atoms['coord']))
+
+    if output == "table":
+        fields = list(RESIDUE_FIELDS)
+        table = pd.DataFrame({
+            'patch': np.repeat(patch_names, [len(rows) for rows in patch_atoms]),
+            **{k: atoms[k][np.concatenate(patch_atoms)] for k in fields}
+        } if patch_atoms else {k: [] for k in ['patch'] + fields})
+        return table.drop_duplicates(ignore_index=True)
+
+    _create_patch_objects(
+        patch_names, atoms, patch_atoms, model_name if remove_model else None)
+
+
+@on_cmd_thread
+def _create_patch_objects(
+        patch_names: Sequence[str],
+        atoms: dict,
+        patch_atoms: Sequence[np.ndarray],
+        remove_model_name: str = None):
+    """
+    Copy atoms of each patch, given by rows of
+    atom table, to patch objects.
+    """
+    with local_setting(defer_updates=1):
+        try:
+            for i, (patch_name, rows) in enumerate(zip(patch_names, patch_atoms)):
+                report_progress(i, len(patch_names), 'create patches')
+                select_indices("selected_atoms", atoms['model'][rows], atoms['index'][rows])
+                cmd.create(patch_name, "selected_atoms")
+        finally:
+            cmd.delete("selected_atoms")
+        if remove_model_name:
+            cmd.delete(remove_model_name)
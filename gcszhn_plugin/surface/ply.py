@@ -1,12 +1,24 @@
-from pymol import cmd
+import os
+import glob
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from colour import Color
-from itertools import combinations
-from ..utils import register_pymol_cmd
+from ..utils import (
+    register_pymol_cmd,
+    count_items,
+    local_setting,
+    on_cmd_thread,
+    report_progress,
+    submit_job,
+    with_checkpoints)
 from pymol.cgo import *
-from .mesh_utils import Mesh
+from ..utils import cmd
+from .mesh_utils import Mesh, register_mesh
+from .cgo_buffer import CGOBuffer, load_cgo_buffer
+from .patch import PatchList
 import numpy as np
 
-__all__ = ['load_ply', 'load_ply_with_patch', 'load_giface']
+__all__ = ['load_ply', 'load_ply_async', 'load_ply_many', 'load_ply_with_patch', 'load_giface']
 
 colorDict = {'sky': [0.0, 0.76, 1.0 ],
         'sea': [0.0, 0.90, 0.5 ],
@@ -52,9 +64,16 @@ def hphob_color(hphob):
     hp = hp + 4.5 
     hp = hp/9.0
     #mycolor = [ [COLOR, 1.0, hp[i], 1.0]  for i in range(len(hp)) ]
-    mycolor = [ [1.0, 1.0-hp[i], 1.0]  for i in range(len(hp)) ]
+    mycolor = np.column_stack([np.ones_like(hp), 1.0-hp, np.ones_like(hp)])
     return mycolor
 
+def scale_color(values, minimum, maximum):
+    # rescale [minimum, maximum] of a hydrophobicity scale to
+    # the [-4.5, 4.5] range of hphob_color
+    values = np.asarray(values, dtype=float)
+    span = max(maximum - minimum, np.finfo(float).eps)
+    return hphob_color((values - minimum) / span * 9.0 - 4.5)
+
 # Returns the color of each vertex according to the charge. 
 # The most red colors are the most negative values, and the most 
 # blue colors are the most positive colors.
@@ -75,13 +94,9 @@ def charge_color(charges):
     blue_charges = blue_charges/max_val
     #red_charges[red_charges>1.0] = 1.0
     #blue_charges[blue_charges>1.0] = 1.0
-    green_color  = np.array([0.0]*len(charges))
-    mycolor = [ [0.9999-blue_charges[i], 0.9999-(blue_charges[i]+red_charges[i]), \
-                    0.9999-red_charges[i]]  for i in range(len(charges)) ]
-    for i in range(len(mycolor)):
-        for k in range(3):
-            if mycolor[i][k] < 0:
-                mycolor[i][k] = 0
+    mycolor = np.column_stack([0.9999-blue_charges, 0.9999-(blue_charges+red_charges), \
+                    0.9999-red_charges])
+    mycolor[mycolor < 0] = 0
 
     return mycolor
 
@@ -97,61 +112,152 @@ def hbond_color(hbond):
     return charge_color(hbond)
 
 
-def add_triangle_faces(faces, vertices, colors, normals):
-    obj = []
-    for triangle in faces:
-        obj.extend([BEGIN, TRIANGLES])
-        for i in range(3):
-            i = int(i)
-            obj.append(COLOR)
-            obj.extend(colors[triangle[i]])
-            obj.append(NORMAL)
-            obj.extend(normals[triangle[i]])
-            obj.append(VERTEX)
-            obj.extend(vertices[triangle[i]])
-        obj.extend([END])
+def add_triangle_faces(faces, vertices, colors, normals) -> CGOBuffer:
+    obj = CGOBuffer(len(faces) * 38 + 16)
+    obj.triangles(vertices, faces, np.asarray(colors), np.asarray(normals))
+    return obj
+
+VERTEX_MODES = ('sphere', 'points', 'atoms')
+
+
+class VertexAtoms:
+    """
+    Vertices as pseudoatoms, drawn by pymol native sphere
+    representation instead of one CGO sphere per vertex.
+    Atoms are read from a template of identical records and
+    placed by one `cmd.load_coords` call. Colors are direct
+    RGB color indices set by one `cmd.alter` call, so no
+    named colors are added to the session.
+    """
+
+    # color index bit of pymol direct RGB colors ("0xRRGGBB")
+    TRUE_COLOR_BIT = 0x40000000
+    TEMPLATE_RECORD = (
+        "HETATM    1  V   VTX     1       0.000   0.000   0.000  1.00  0.00           C\n")
+
+    def __init__(self, vertices: np.ndarray, colors: np.ndarray, size: float = 0.2):
+        self.vertices = np.asarray(vertices, dtype=float).reshape(-1, 3)
+        rgb = np.clip(np.round(np.asarray(colors, dtype=float)[:, :3] * 255), 0, 255).astype(np.int64)
+        self.color_indices = self.TRUE_COLOR_BIT | (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+        self.size = float(size)
+
+    def load(self, name: str, state=1):
+        state = int(state)
+        # template atoms share one position, skip distance based bonds
+        with local_setting(connect_mode=1):
+            cmd.read_pdbstr(self.TEMPLATE_RECORD * len(self.vertices), name, state)
+        cmd.load_coords(self.vertices, name, state=state)
+        cmd.alter(
+            name, 'color = _colors[index - 1]; vdw = _size',
+            space={'_colors': self.color_indices.tolist(), '_size': self.size})
+        cmd.show_as('spheres', name)
+        cmd.recolor(name)
+
+
+def build_vertex_layer(verts, colors, vertex_mode='sphere', vertex_size=0.2, point_size=3.0):
+    """
+    Build vertex layer in given mode.
+
+    Parameters
+    ----------
+    vertex_mode: str
+        "sphere" for one CGO sphere per vertex,
+        "points" for one CGO POINTS block,
+        "atoms" for pseudoatoms drawn as spheres.
+    vertex_size: float
+        Sphere radius of "sphere" and "atoms" mode.
+    point_size: float
+        Point width in pixels of "points" mode.
+    """
+    colors = np.asarray(colors, dtype=float)
+    if vertex_mode == 'sphere':
+        obj = CGOBuffer(len(verts) * 9)
+        obj.spheres(verts, float(vertex_size), colors=colors)
+    elif vertex_mode == 'points':
+        obj = CGOBuffer(len(verts) * 8 + 16)
+        obj.points(verts, colors=colors)
+        obj.settings['cgo_dot_width'] = float(point_size)
+    elif vertex_mode == 'atoms':
+        obj = VertexAtoms(verts, colors, size=float(vertex_size))
+    else:
+        raise ValueError(f"Unknown vertex mode: {vertex_mode}")
     return obj
 
 
+def load_layer(name, obj, state=1.0):
+    """
+    Load a layer built by `build_vertex_layer` or a CGO buffer.
+    """
+    if isinstance(obj, VertexAtoms):
+        obj.load(name, state)
+    else:
+        load_cgo_buffer(obj, name, state)
+
+
+def _to_rgb(color) -> list:
+    if isinstance(color, str):
+        return colorDict[color]
+    elif isinstance(color, (list, tuple)) and len(color) == 3:
+        return list(color)
+    else:
+        raise ValueError("Color must be a string or a list of 3 values")
+
+
 @register_pymol_cmd
 def load_ply_with_patch(ply_file, patch_list_file, *patch_id_colors, name = None, backgroud_color = 'gray'):
     if not name:
         name = os.path.basename(ply_file).split('.')[0]
-    mesh = Mesh.create_mesh()
-    mesh.load_mesh(ply_file)
-    patch_list = np.load(patch_list_file, allow_pickle=True)
-    patch_dict = {patch[0]: patch for patch in patch_list}
+    mesh = Mesh.read(ply_file)
+    patch_list = PatchList.load(patch_list_file)
     vertices = mesh.vertices
     faces = mesh.faces
-    colors = [colorDict[backgroud_color]]*len(vertices)
-    for patch_id, color in patch_id_colors:
-        patch = patch_dict[patch_id]
-        for i in patch:
-            if isinstance(color, str):
-                colors[i] = colorDict[color]
-            elif isinstance(color, list):
-                colors[i] = color
-            else:
-                raise ValueError("Color must be a string or a list of 3 values")
-    nx = mesh.get_attribute('vertex_nx')
-    ny = mesh.get_attribute('vertex_ny')
-    nz = mesh.get_attribute('vertex_nz')
-    normals = np.vstack([nx, ny, nz]).T
-
-    obj = add_triangle_faces(faces, vertices, colors, normals)
-    cmd.load_cgo(obj, name)
-
-
-@register_pymol_cmd
-def load_ply(filename, group_name = None, vertex_size=0.2, enable_properties = None):
-    mesh = Mesh.create_mesh()
-    mesh.load_mesh(filename)
+    count_items(len(vertices))
+    colors = np.tile(np.array(_to_rgb(backgroud_color), dtype=float), (len(vertices), 1))
+    if patch_id_colors:
+        patch_ids, patch_colors = zip(*patch_id_colors)
+        patch_vertices, patch_owners = patch_list.gather(patch_ids)
+        patch_colors = np.array([_to_rgb(color) for color in patch_colors], dtype=float)
+        colors[patch_vertices] = patch_colors[patch_owners]
+    obj = add_triangle_faces(faces, vertices, colors, mesh.normals)
+    load_cgo_buffer(obj, name)
+
+
+def build_ply_cgo(filename, group_name = None, vertex_size=0.2, enable_properties = None,
+                  vertex_mode = 'sphere', point_size = 3.0):
+    """
+    Parse mesh and build CGO of each layer of `load_ply`
+    without touching pymol, so it can run in worker threads.
+
+    Returns
+    ----------
+    Group name and list of (object name, CGO) of each layer.
+    """
+    mesh = Mesh.read(filename)
     if not group_name:
         group_name = os.path.basename(filename).split('.')[0]
-    group_members = []
-    with_normal = False
+    register_mesh(group_name, filename)
+    return group_name, build_mesh_cgo(
+        mesh, group_name, vertex_size, enable_properties, vertex_mode, point_size)
+
+
+def build_mesh_cgo(mesh, group_name, vertex_size=0.2, enable_properties = None,
+                   vertex_mode = 'sphere', point_size = 3.0):
+    """
+    Build CGO of each layer of `load_ply` from a mesh.
+
+    Returns
+    ----------
+    List of (object name, CGO) of each layer.
+    """
+    cgo_objects = []
+
+    def _add_layer(name, obj):
+        cgo_objects.append((name, obj))
+        report_progress(len(cgo_objects), message=f'build {name}')
+
     verts = mesh.vertices
-    faces = mesh.faces
+    faces = np.asarray(mesh.faces)
+    count_items(len(verts))
 
     try:
         if enable_properties is None or enable_properties[0] == 'vertex_charge':
@@ -167,160 +273,197 @@ def load_ply(filename, group_name = None, vertex_size=0.2, enable_properties = N
         elif enable_properties[0] == 'vertex_hbond':
             color_array = hbond_color(mesh.get_attribute("vertex_hbond"))
         else:
-            color_array = [colorDict['green']]*len(verts)
+            color_array = np.tile(colorDict['green'], (len(verts), 1))
     except:
-        color_array = [colorDict['green']]*len(verts)
+        color_array = np.tile(colorDict['green'], (len(verts), 1))
 
-    if 'vertex_nx' in mesh.get_attribute_names():
-        nx = mesh.get_attribute('vertex_nx')
-        ny = mesh.get_attribute('vertex_ny')
-        nz = mesh.get_attribute('vertex_nz')
-        normals = np.vstack([nx, ny, nz]).T
-        with_normal = True
+    normals = mesh.normals
+    with_normal = normals is not None
 
     # Draw vertices 
-    obj = []
-    for v_ix in range(len(verts)):
-        vert = verts[v_ix]
-        colorToAdd = color_array[v_ix]
-        # Vertices
-        obj.append(COLOR)
-        obj.extend(colorToAdd)
-        obj.extend([SPHERE, vert[0], vert[1], vert[2], vertex_size])
+    obj = build_vertex_layer(verts, color_array, vertex_mode, vertex_size, point_size)
 
-    group_members.append(group_name + "_vertices")
-    cmd.load_cgo(obj, group_members[-1], 1.0)
+    _add_layer(group_name + "_vertices", obj)
 
 
     if with_normal:
         # Draw surface charges.
-        if 'vertex_charge' in mesh.get_attribute_names() and (enable_properties is None or 'vertex_charge' in enable_properties): 
+        if 'vertex_charge' in mesh.attribute_names and (enable_properties is None or 'vertex_charge' in enable_properties): 
             color_array_surf = charge_color(mesh.get_attribute("vertex_charge"))
             obj = add_triangle_faces(faces, verts, color_array_surf, normals)
-            group_members.append(group_name + "_vertex_charge")
-            cmd.load_cgo(obj, group_members[-1], 1.0)
+            _add_layer(group_name + "_vertex_charge", obj)
 
         # Draw hydrophobicity
-        if 'vertex_hphob' in mesh.get_attribute_names() and (enable_properties is None or 'vertex_hphob' in enable_properties): 
+        if 'vertex_hphob' in mesh.attribute_names and (enable_properties is None or 'vertex_hphob' in enable_properties): 
             hphob = mesh.get_attribute('vertex_hphob')
             color_array_surf = hphob_color(hphob)
             obj = add_triangle_faces(faces, verts, color_array_surf, normals)
-            group_members.append(group_name + "_vertex_hphob")
-            cmd.load_cgo(obj, group_members[-1], 1.0)
+            _add_layer(group_name + "_vertex_hphob", obj)
 
         # Draw shape index
-        if 'vertex_si' in mesh.get_attribute_names() and (enable_properties is None or 'vertex_si' in enable_properties): 
+        if 'vertex_si' in mesh.attribute_names and (enable_properties is None or 'vertex_si' in enable_properties): 
             color_array_surf = si_color(mesh.get_attribute('vertex_si'))
             obj = add_triangle_faces(faces, verts, color_array_surf, normals)
-            group_members.append(group_name + "_vertex_si")
-            cmd.load_cgo(obj, group_members[-1], 1.0)
+            _add_layer(group_name + "_vertex_si", obj)
 
         # Draw ddc
-        if 'vertex_ddc' in mesh.get_attribute_names() and (enable_properties is None or 'vertex_ddc' in enable_properties): 
+        if 'vertex_ddc' in mesh.attribute_names and (enable_properties is None or 'vertex_ddc' in enable_properties): 
             # Scale to -1.0->1.0
             color_array_surf = ddc_color(mesh.get_attribute('vertex_ddc') * 1.4285)
             obj = add_triangle_faces(faces, verts, color_array_surf, normals)
-            group_members.append(group_name + "_vertex_ddc")
-            cmd.load_cgo(obj,group_members[-1], 1.0)
+            _add_layer(group_name + "_vertex_ddc", obj)
 
         # Draw iface
-        if 'vertex_iface' in mesh.get_attribute_names() and (enable_properties is None or 'vertex_iface' in enable_properties): 
+        if 'vertex_iface' in mesh.attribute_names and (enable_properties is None or 'vertex_iface' in enable_properties): 
             color_array_surf = iface_color(mesh.get_attribute('vertex_iface'))
             obj = add_triangle_faces(faces, verts, color_array_surf, normals)
-            group_members.append(group_name + "_vertex_iface")
-            cmd.load_cgo(obj, group_members[-1], 1.0)
+            _add_layer(group_name + "_vertex_iface", obj)
 
         # Draw hbond
-        if 'vertex_hbond' in mesh.get_attribute_names() and (enable_properties is None or 'vertex_hbond' in enable_properties): 
+        if 'vertex_hbond' in mesh.attribute_names and (enable_properties is None or 'vertex_hbond' in enable_properties): 
             color_array_surf = charge_color(mesh.get_attribute('vertex_hbond'))
             obj = add_triangle_faces(faces, verts, color_array_surf, normals)
-            group_members.append(group_name + "_vertex_hbond")
-            cmd.load_cgo(obj, group_members[-1], 1.0)
+            _add_layer(group_name + "_vertex_hbond", obj)
 
         # Draw normals
-        obj = []
         if enable_properties is None or 'normal' in enable_properties:
-            for v_ix in range(len(verts)):
-                colorToAdd = colorDict['white']
-                vert1 = verts[v_ix]
-                vert2 = [verts[v_ix][0]+nx[v_ix],\
-                        verts[v_ix][1]+ny[v_ix],\
-                        verts[v_ix][2]+nz[v_ix]]
-                obj.extend([LINEWIDTH, 2.0])
-                obj.extend([BEGIN, LINES])
-                obj.append(COLOR)
-                obj.extend(colorToAdd)
-                obj.extend([VERTEX, (vert1[0]), (vert1[1]), (vert1[2])])
-                obj.extend([VERTEX, (vert2[0]), (vert2[1]), (vert2[2])])
-                obj.append(END)
-            group_members.append(group_name + "_normal")
-            cmd.load_cgo(obj, group_members[-1], 1.0)
+            obj = CGOBuffer(len(verts) * 8 + 16)
+            obj.lines(verts, verts + normals, color=colorDict['white'], width=2.0)
+            _add_layer(group_name + "_normal", obj)
 
 
     # Draw triangles (faces)
     if enable_properties is None or 'mesh' in enable_properties:
-        obj = []
-        for tri in faces: 
-            colorToAdd = colorDict['gray']
-            for line in combinations(tri, 2): 
-                obj.extend([BEGIN, LINES])
-                obj.append(COLOR)
-                obj.extend(colorToAdd)
-                for vert in line: 
-                    obj.append(VERTEX)
-                    obj.extend(verts[vert])
-                obj.append(END)
-        group_members.append(group_name + "_mesh") 
-        cmd.load_cgo(obj, group_members[-1], 1.0)
-
-    cmd.group(group_name, " ".join(group_members))
+        obj = CGOBuffer(len(faces) * 24 + 16)
+        # the three edges of each triangle
+        obj.lines(
+            verts[faces[:, [0, 0, 1]]],
+            verts[faces[:, [1, 2, 2]]],
+            color=colorDict['gray'])
+        _add_layer(group_name + "_mesh", obj)
+
+    return cgo_objects
+
+
+@on_cmd_thread
+def load_cgo_group(group_name, cgo_objects):
+    """
+    Load CGO objects and group them.
+    """
+    for name, obj in cgo_objects:
+        load_layer(name, obj, 1.0)
+    cmd.group(group_name, " ".join(name for name, _ in cgo_objects))
+
+
+@register_pymol_cmd
+def load_ply(filename, group_name = None, vertex_size=0.2, enable_properties = None,
+             vertex_mode = 'sphere', point_size = 3.0):
+    """
+    Load 3D object (*.ply) as mesh.
+
+    Parameters
+    ----------
+    vertex_mode: str
+        Rendering of vertices layer, "sphere" for CGO
+        spheres, "points" for CGO points (fast for large
+        meshes), "atoms" for pseudoatoms drawn as spheres.
+    vertex_size: float
+        Sphere radius of "sphere" and "atoms" mode.
+    point_size: float
+        Point width in pixels of "points" mode.
+    """
+    load_cgo_group(*build_ply_cgo(
+        filename, group_name, vertex_size, enable_properties, vertex_mode, point_size))
+
+
+@register_pymol_cmd
+def load_ply_async(filename, group_name = None, vertex_size=0.2, enable_properties = None,
+                   vertex_mode = 'sphere', point_size = 3.0) -> int:
+    """
+    Run `load_ply` as background job,
+    see `plugin_jobs` and `cancel_plugin_job`.
+    """
+    return submit_job(
+        'load_ply', load_ply, filename, group_name, vertex_size, enable_properties,
+        vertex_mode, point_size).id
+
+
+@register_pymol_cmd
+def load_ply_many(filenames, prefix = '', vertex_size=0.2, enable_properties = None, workers = 0, pool = 'thread',
+                  vertex_mode = 'sphere', point_size = 3.0):
+    """
+    Load many 3D objects (*.ply) as `load_ply`. Meshes are
+    parsed and CGO are built in a worker pool, only loading
+    CGO into pymol is serialized on the calling thread.
+
+    Parameters
+    ----------
+    filenames: str or List[str]
+        Glob pattern or list of mesh files.
+    prefix: str
+        Prefix of group names, followed by file
+        name without suffix.
+    workers: int
+        Number of workers, 0 for number of cores.
+    pool: str
+        Only "thread" pool is supported. Processes spawned
+        from embedded pymol would not share mesh cache
+        settings, statistics and progress of the session.
+    """
+    if isinstance(filenames, str):
+        filenames = sorted(glob.glob(filenames))
+    if pool != 'thread':
+        raise ValueError(f"Unsupported pool: {pool}, only thread pool is supported")
+
+    # workers stop building when cancelled, progress is reported per mesh
+    build = with_checkpoints(build_ply_cgo)
+    with ThreadPoolExecutor(max_workers=int(workers) or None) as executor:
+        futures = {
+            executor.submit(
+                build,
+                filename,
+                prefix + os.path.basename(filename).split('.')[0],
+                vertex_size,
+                enable_properties,
+                vertex_mode,
+                point_size): filename
+            for filename in filenames}
+        try:
+            for i, future in enumerate(as_completed(futures), 1):
+                group_name, cgo_objects = future.result()
+                load_cgo_group(group_name, cgo_objects)
+                report_progress(i, len(futures), 'load meshes')
+        finally:
+            # meshes not started yet are dropped if loading stops
+            for future in futures:
+                future.cancel()
 
 
 @register_pymol_cmd
 def load_giface(filename, color="white", name='giface', dotSize=0.2, lineSize = 1.0):
-    mesh = Mesh.create_mesh()
-    mesh.load_mesh(filename)
-    if 'vertex_iface' not in mesh.get_attribute_names():
+    mesh = Mesh.read(filename)
+    if 'vertex_iface' not in mesh.attribute_names:
         return
     iface = mesh.get_attribute('vertex_iface')
     # Color an edge only if:
         # iface > 0 for its two edges
         # iface is zero for at least one of its edges.
     # Go through each face. 
-    faces = mesh.faces
+    faces = np.asarray(mesh.faces)
     verts = mesh.vertices
-    obj = []
-    visited = set()
-    colorToAdd = colorDict['green']
-    obj.extend([BEGIN, LINES])
-    obj.extend([LINEWIDTH, 5.0])
-    obj.extend(colorToAdd)
-    for tri in faces: 
-        pairs = [[tri[0],tri[1], tri[2]], [tri[0],tri[2], tri[1]], [tri[1],tri[2], tri[0]]]
-        for pair in pairs: 
-            if iface[pair[0]] > 0 and iface[pair[1]] > 0 and iface[pair[2]] == 0:
-                vert1 = verts[pair[0]]
-                vert2 = verts[pair[1]]
-
-                obj.extend([VERTEX, (vert1[0]), (vert1[1]), (vert1[2])])
-                obj.extend([VERTEX, (vert2[0]), (vert2[1]), (vert2[2])])
-    obj.append(END)
+    count_items(len(verts))
+    edges = []
+    for a, b, c in ((0, 1, 2), (0, 2, 1), (1, 2, 0)):
+        tri = faces[(iface[faces[:, a]] > 0) & (iface[faces[:, b]] > 0) & (iface[faces[:, c]] == 0)]
+        edges.append(tri[:, [a, b]])
+    edges = np.concatenate(edges)
+
+    obj = CGOBuffer(len(edges) * 8 + 16)
+    obj.lines(verts[edges[:, 0]], verts[edges[:, 1]], color=colorDict['green'], width=5.0)
     name = "giface_"+filename 
-    cmd.load_cgo(obj,name, 1.0)
-    colorToAdd = colorDict['green']
-
-    obj = []
-    obj.extend(colorToAdd)
-    for tri in faces: 
-        pairs = [[tri[0],tri[1], tri[2]], [tri[0],tri[2], tri[1]], [tri[1],tri[2], tri[0]]]
-        for pair in pairs: 
-            if iface[pair[0]] > 0 and iface[pair[1]] > 0 and iface[pair[2]] == 0:
-                vert1 = verts[pair[0]]
-                vert2 = verts[pair[1]]
-
-                obj.extend([SPHERE, (vert1[0]), (vert1[1]), (vert1[2]), 0.4])
-                obj.extend([SPHERE, (vert2[0]), (vert2[1]), (vert2[2]), 0.4])
-    #obj.append(END)
-    name = "giface_verts_"+filename 
-    cmd.load_cgo(obj,name, 1.0)
- 
+    load_cgo_buffer(obj, name, 1.0)
+
+    obj = CGOBuffer(len(edges) * 10 + 16)
+    obj.spheres(verts[edges.ravel()], 0.4, color=colorDict['green'])
+    name = "giface_verts_"+filename
+    load_cgo_buffer(obj, name, 1.0)
@@ -0,0 +1,226 @@
+import os
+import numpy as np
+import pandas as pd
+
+from ..utils import cmd
+from scipy.spatial import cKDTree
+from .mesh_utils import Mesh, register_mesh
+from .ply import scale_color, build_vertex_layer, load_layer, add_triangle_faces
+from ..pdb.hydro import HYDRO_SCALE_MAP
+from ..utils import (
+    register_pymol_cmd,
+    count_items,
+    get_atom_table,
+    write_atom_values,
+    call_on_cmd_thread,
+    report_progress,
+    as_bool,
+    RESIDUE_FIELDS)
+
+__all__ = ['project_surface_attribute', 'project_hydro_scale']
+
+# atoms are queried against vertex index in chunks
+# to bound memory of intermediate arrays.
+QUERY_CHUNK_SIZE = 100000
+
+
+def nearest_vertices(
+        vertices: np.ndarray,
+        points: np.ndarray,
+        distance_threshold: float = np.inf,
+        tree: cKDTree = None):
+    """
+    Find the nearest mesh vertex of each point.
+
+    Returns
+    ----------
+    Distances and vertex indices. Points without vertex
+    closer than `distance_threshold` get `inf` distance
+    and index `len(vertices)`.
+    """
+    if tree is None:
+        tree = cKDTree(vertices)
+    dists = np.empty(len(points))
+    indices = np.empty(len(points), dtype=np.int64)
+    for i in range(0, len(points), QUERY_CHUNK_SIZE):
+        report_progress(i, len(points), 'query vertices')
+        dists[i:i + QUERY_CHUNK_SIZE], indices[i:i + QUERY_CHUNK_SIZE] = tree.query(
+            points[i:i + QUERY_CHUNK_SIZE],
+            distance_upper_bound=distance_threshold,
+            workers=-1)
+    return dists, indices
+
+
+def idw_values(
+        tree: cKDTree,
+        values: np.ndarray,
+        points: np.ndarray,
+        k: int = 1,
+        distance_threshold: float = np.inf,
+        fill_value: float = np.nan) -> np.ndarray:
+    """
+    Inverse-distance weighted value of the `k` nearest
+    indexed items of each point. Points without item closer
+    than `distance_threshold` get `fill_value`.
+    """
+    values = np.append(np.asarray(values, dtype=float), 0.0)
+    result = np.empty(len(points))
+    for i in range(0, len(points), QUERY_CHUNK_SIZE):
+        report_progress(i, len(points), 'interpolate values')
+        dists, indices = tree.query(
+            points[i:i + QUERY_CHUNK_SIZE], k=k,
+            distance_upper_bound=distance_threshold, workers=-1)
+        dists = dists.reshape(len(dists), -1)
+        indices = indices.reshape(len(indices), -1)
+        # missing neighbors have inf distance, so zero weight
+        weights = 1.0 / np.maximum(dists, 1e-6)
+        total = weights.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            chunk = (weights * values[indices]).sum(axis=1) / total
+        chunk[total == 0] = fill_value
+        result[i:i + QUERY_CHUNK_SIZE] = chunk
+    return result
+
+
+@register_pymol_cmd
+def project_surface_attribute(
+        ply_file: str,
+        attribute: str = 'vertex_charge',
+        selection: str = '(all)',
+        level: str = 'R',
+        aggregate: str = 'mean',
+        distance_threshold: float = 4.0,
+        store: bool = True,
+        fill_value: float = 0.0,
+        palette: str = None) -> pd.DataFrame:
+    """
+    Project a mesh vertex attribute onto atoms and
+    residues. Each atom takes the value of its nearest
+    vertex, found by a KD-tree over mesh vertices.
+
+    Parameters
+    ----------
+    ply_file: str
+        Mesh file, such as MaSIF output.
+    attribute: str
+        Vertex attribute name, such as `vertex_charge`,
+        `vertex_hphob`, `vertex_iface` or `vertex_si`.
+    selection: str
+        pymol selection string.
+    level: str
+        'A' for atomic level,
+        'R' for residual level.
+    aggregate: str
+        Aggregation of atom values in residue level,
+        one of 'mean', 'max', 'min', 'sum'.
+    distance_threshold: float
+        Atoms without vertex within this distance
+        (buried atoms) get no value.
+    store: bool
+        If True, store values in b-factors. Atoms without
+        value get `fill_value`.
+    palette: str
+        If given, color selection by stored values
+        with `cmd.spectrum`.
+
+    Returns
+    ----------
+    Table of projected value of each atom or residue.
+    """
+    if level not in ('A', 'R'):
+        raise ValueError(f"Unknown level: {level}")
+    if aggregate not in ('mean', 'max', 'min', 'sum'):
+        raise ValueError(f"Unknown aggregate: {aggregate}")
+
+    mesh = Mesh.read(ply_file)
+    vertex_values = np.append(
+        np.asarray(mesh.get_attribute(attribute), dtype=float), np.nan)
+
+    atoms = get_atom_table(selection, fields=RESIDUE_FIELDS + ('index', 'name'), coords=True)
+    count_items(len(atoms['coord']) + len(mesh.vertices))
+    _, nearest = nearest_vertices(
+        mesh.vertices, atoms['coord'], distance_threshold=float(distance_threshold))
+    table = pd.DataFrame({k: v for k, v in atoms.items() if k != 'coord'})
+    table['value'] = vertex_values[nearest]
+
+    if level == 'R':
+        atom_values = table.groupby(list(RESIDUE_FIELDS), sort=False)['value'].transform(aggregate)
+        table = table.groupby(list(RESIDUE_FIELDS), sort=False, as_index=False)['value'].agg(aggregate)
+    else:
+        atom_values = table['value']
+
+    if as_bool(store):
+        minimum, maximum = write_atom_values(
+            selection, atom_values.fillna(float(fill_value)).to_numpy())
+        if palette and len(atom_values):
+            cmd.spectrum('b', palette, selection, minimum=minimum, maximum=maximum)
+    return table
+
+
+@register_pymol_cmd
+def project_hydro_scale(
+        ply_file: str,
+        selection: str = '(all)',
+        scale_name: str = 'Ja',
+        k: int = 1,
+        distance_threshold: float = np.inf,
+        name: str = None,
+        vertex_mode: str = 'points') -> np.ndarray:
+    """
+    Project residue hydrophobicity scale onto mesh
+    vertices and draw the colored surface. Each vertex
+    takes the scale value of the residue of its nearest
+    atom, or the inverse-distance weighted value of the
+    `k` nearest atoms.
+
+    Parameters
+    ----------
+    ply_file: str
+        Mesh file.
+    selection: str
+        pymol selection string of the structure.
+    scale_name: str
+        Name of hydrophobicity scale.
+        list all by `avail_hydro_scales()`.
+    k: int
+        Number of nearest atoms weighted.
+    distance_threshold: float
+        Vertices without atom within this distance
+        get the middle value of the scale.
+    name: str
+        Name of surface object, default is
+        `{mesh file name}_{scale_name}`.
+    vertex_mode: str
+        Rendering of meshes without faces,
+        see `load_ply`.
+
+    Returns
+    ----------
+    Scale value of each vertex, also stored as
+    `vertex_hphob` attribute of the mesh.
+    """
+    scale_map = HYDRO_SCALE_MAP[scale_name]
+    minimum, maximum = float(scale_map.min()), float(scale_map.max())
+    mesh = Mesh.read(ply_file)
+    atoms = get_atom_table(selection, fields=('resn',), coords=True)
+    if len(atoms['coord']) == 0:
+        raise ValueError(f"No atom in selection {selection}")
+    count_items(len(atoms['coord']) + len(mesh.vertices))
+
+    atom_values = scale_map.reindex(atoms['resn']).fillna(0).to_numpy()
+    values = idw_values(
+        cKDTree(atoms['coord']), atom_values, mesh.vertices, k=int(k),
+        distance_threshold=float(distance_threshold),
+        fill_value=(minimum + maximum) / 2)
+    mesh.set_attribute('vertex_hphob', values)
+
+    if not name:
+        name = f"{os.path.basename(ply_file).split('.')[0]}_{scale_name}"
+    colors = scale_color(values, minimum, maximum)
+    if mesh.faces is not None and len(mesh.faces):
+        layer = add_triangle_faces(mesh.faces, mesh.vertices, colors, mesh.normals)
+    else:
+        layer = build_vertex_layer(mesh.vertices, colors, vertex_mode)
+    call_on_cmd_thread(load_layer, name, layer)
+    register_mesh(name, mesh)
+    return values
@@ -1,26 +1,309 @@
+import json
+import hashlib
+import time
+import queue
+import inspect
+import logging
+import itertools
 import threading
 import functools
+import tracemalloc
+import numpy as np
+import pandas as pd
 
-from pymol import cmd
-from typing import List
+from pymol import cmd as pymol_cmd
+from typing import Any, Callable, Dict, List, Sequence, Tuple
 from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 __reigster_pymol_cmd__ = dict()
 
 
+class CommandStats:
+    """
+    Accumulated instrumentation of a registered command.
+    Wall time, `cmd.*` calls and items are inclusive of
+    nested registered commands.
+    """
+
+    __slots__ = (
+        'calls', 'errors', 'wall_time', 'max_wall_time',
+        'cmd_calls', 'items', 'peak_memory')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.wall_time = 0.0
+        self.max_wall_time = 0.0
+        self.cmd_calls = 0
+        self.items = 0
+        self.peak_memory = 0
+
+    def as_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class _StatsFrame:
+
+    __slots__ = ('cmd_calls', 'items')
+
+    def __init__(self):
+        self.cmd_calls = 0
+        self.items = 0
+
+
+__plugin_stats__: Dict[str, CommandStats] = dict()
+_stats_config = {'enabled': False, 'memory': False}
+_stats_local = threading.local()
+
+
+class PluginCmd:
+    """
+    Thin proxy of `pymol.cmd` imported by plugin modules
+    instead of the module itself. Calls through it are
+    counted for the registered command running on the
+    calling thread, while `pymol.cmd` is left untouched.
+    """
+
+    def __init__(self, module):
+        self._module = module
+        self._wrappers = dict()
+
+    def __getattr__(self, name: str):
+        value = getattr(self._module, name)
+        if name.startswith('_') or not inspect.isroutine(value):
+            return value
+        wrapper = self._wrappers.get(name)
+        if wrapper is None or wrapper.__wrapped__ is not value:
+            wrapper = self._wrappers[name] = _count_cmd_call(value)
+        return wrapper
+
+    def __dir__(self):
+        return dir(self._module)
+
+
+def _count_cmd_call(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        frames = getattr(_stats_local, 'frames', None)
+        if frames:
+            frames[-1].cmd_calls += 1
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+cmd = PluginCmd(pymol_cmd)
+
+
+class _PeakBlock:
+
+    __slots__ = ('start', 'peak')
+
+    def __init__(self, start: int):
+        self.start = start
+        self.peak = start
+
+
+_peak_lock = threading.Lock()
+_peak_blocks: List[_PeakBlock] = []
+
+
+def _fold_peak():
+    # the peak since last reset is kept by every open block
+    # before it is reset, so that nested or concurrent blocks
+    # never lose a peak reached before they close.
+    peak = tracemalloc.get_traced_memory()[1]
+    for block in _peak_blocks:
+        block.peak = max(block.peak, peak)
+
+
+def _open_peak_block() -> _PeakBlock:
+    with _peak_lock:
+        _fold_peak()
+        tracemalloc.reset_peak()
+        block = _PeakBlock(tracemalloc.get_traced_memory()[0])
+        _peak_blocks.append(block)
+    return block
+
+
+def _close_peak_block(block: _PeakBlock) -> int:
+    with _peak_lock:
+        if tracemalloc.is_tracing():
+            _fold_peak()
+        _peak_blocks.remove(block)
+    return max(block.peak - block.start, 0)
+
+
+@contextmanager
+def traced_peak():
+    """
+    Trace peak python allocation of the block, in bytes
+    above the allocation at its start. The peak is reset
+    per block and the peak seen before each reset is kept
+    by enclosing blocks, so blocks may nest or run in
+    other threads. `tracemalloc` must be tracing.
+
+    Yields
+    ------
+    list
+        Receives the peak when the block exits.
+    """
+    peak = []
+    block = _open_peak_block()
+    try:
+        yield peak
+    finally:
+        peak.append(_close_peak_block(block))
+
+
+def count_items(n: int):
+    """
+    Report number of atoms/vertices processed by
+    current registered command. It is a no-op when
+    instrumentation is disabled.
+    """
+    frames = getattr(_stats_local, 'frames', None)
+    if frames:
+        frames[-1].items += int(n)
+
+
+def _run_instrumented(name: str, func, args, kwargs):
+    frames = getattr(_stats_local, 'frames', None)
+    if frames is None:
+        frames = _stats_local.frames = []
+    memory = _open_peak_block() if tracemalloc.is_tracing() else None
+    frame = _StatsFrame()
+    frames.append(frame)
+    stats = __plugin_stats__.setdefault(name, CommandStats())
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    except BaseException:
+        stats.errors += 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        frames.pop()
+        if frames:
+            frames[-1].cmd_calls += frame.cmd_calls
+            frames[-1].items += frame.items
+        stats.calls += 1
+        stats.wall_time += elapsed
+        stats.max_wall_time = max(stats.max_wall_time, elapsed)
+        stats.cmd_calls += frame.cmd_calls
+        stats.items += frame.items
+        if memory is not None:
+            stats.peak_memory = max(stats.peak_memory, _close_peak_block(memory))
+
+
 def register_pymol_cmd(func):
-    __reigster_pymol_cmd__[func.__name__] = func
-    return func
+    name = func.__name__
+
+    def _call(args, kwargs):
+        if not _stats_config['enabled']:
+            return func(*args, **kwargs)
+        return _run_instrumented(name, func, args, kwargs)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _in_job_context():
+            return _call(args, kwargs)
+        return _run_foreground(name, _call, args, kwargs)
+
+    __reigster_pymol_cmd__[name] = wrapper
+    return wrapper
+
+
+def as_bool(value) -> bool:
+    """
+    Convert pymol command line argument to bool.
+    """
+    if isinstance(value, str):
+        return value.strip().lower() not in ('', '0', 'false', 'off', 'no', 'none')
+    return bool(value)
+
+
+def enable_plugin_stats(enabled: bool = True, memory: bool = False):
+    """
+    Turn command instrumentation on or off. Tracing
+    python allocation by `tracemalloc` is expensive,
+    so it is only enabled when `memory` is True.
+    Only `pymol.cmd` calls made by plugin code through
+    `PluginCmd` are counted.
+    """
+    if enabled:
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _stats_config['memory'] = True
+    else:
+        if _stats_config['memory']:
+            tracemalloc.stop()
+            _stats_config['memory'] = False
+    _stats_config['enabled'] = bool(enabled)
+
+
+@register_pymol_cmd
+def plugin_stats(action: str = 'print', filename: str = None, memory: bool = False):
+    """
+    Instrumentation of registered plugin commands.
+
+    Parameters
+    ----------
+    action : str, optional
+        One of "on", "off", "print", "dump", "reset".
+        on/off: enable or disable instrumentation.
+        print: print per-command report.
+        dump: dump per-command report to `filename`,
+        in csv format if suffix is ".csv", otherwise json.
+        reset: clear collected statistics.
+    filename : str, optional
+        Output file of "dump" action.
+    memory : bool, optional
+        Also trace peak python allocation when turned on.
+    """
+    if action == 'on':
+        enable_plugin_stats(True, memory=as_bool(memory))
+    elif action == 'off':
+        enable_plugin_stats(False)
+    elif action == 'reset':
+        __plugin_stats__.clear()
+    elif action == 'print':
+        header = f"{'command':<28}{'calls':>7}{'errors':>7}{'total(s)':>11}" \
+                 f"{'max(s)':>10}{'cmd calls':>11}{'items':>11}{'peak(MB)':>10}"
+        print(header)
+        for name, stats in sorted(
+                __plugin_stats__.items(), key=lambda x: -x[1].wall_time):
+            print(f"{name:<28}{stats.calls:>7}{stats.errors:>7}"
+                  f"{stats.wall_time:>11.3f}{stats.max_wall_time:>10.3f}"
+                  f"{stats.cmd_calls:>11}{stats.items:>11}"
+                  f"{stats.peak_memory / 2 ** 20:>10.2f}")
+    elif action == 'dump':
+        if not filename:
+            raise ValueError("filename is required for dump action")
+        report = {k: v.as_dict() for k, v in __plugin_stats__.items()}
+        if filename.endswith('.csv'):
+            pd.DataFrame.from_dict(report, orient='index').to_csv(
+                filename, index_label='command')
+        else:
+            with open(filename, 'w') as f:
+                json.dump(report, f, indent=2)
+    else:
+        raise ValueError(f"Unknown action: {action}")
 
 
 @contextmanager
 def local_setting(**kwargs):
     old_settings = {k: cmd.get(k) for k in kwargs}
-    for k, v in kwargs.items():
-        cmd.set(k, v)
-    yield kwargs
-    for k, v in old_settings.items():
-        cmd.set(k, v)
+    try:
+        for k, v in kwargs.items():
+            cmd.set(k, v)
+        yield kwargs
+    finally:
+        # also restored when command fails or is cancelled
+        for k, v in old_settings.items():
+            cmd.set(k, v)
 
 
 def residue_format(resn: str, resi: str, chain: str, selection: str) -> str:
@@ -45,36 +328,786 @@ def lock(func):
     return wrapper
 
 
-def int_array_to_str(int_array: List[int], prefix="") -> str:
+class JobCancelled(Exception):
+    """Raised at a checkpoint of a cancelled job."""
+
+
+class Job:
+    """
+    Background job of a plugin command, see `submit_job`.
+    """
+
+    def __init__(self, job_id: int, name: str):
+        self.id = job_id
+        self.name = name
+        self.status = 'pending'
+        self.done = 0
+        self.total = None
+        self.message = ''
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self.foreground = False
+        self._cancel_event = threading.Event()
+        self._stage = None
+        self._reported = 0.0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        self._cancel_event.set()
+        if self.future is not None and self.future.cancel():
+            # never started, so it is finished now
+            self.status = 'cancelled'
+            self.finished = time.time()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(f"job {self.id} ({self.name}) is cancelled")
+
+    def set_progress(self, done: int, total: int = None, message: str = None):
+        if (self._stage is None or done < self.done
+                or total is not None and total != self.total
+                or message is not None and message != self.message):
+            # rate and ETA are estimated within one stage
+            self._stage = (time.time(), done)
+        self.done = done
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self.message = message
+
+    @property
+    def rate(self) -> float:
+        """Items processed per second in current stage."""
+        if self._stage is None or self.finished is not None:
+            return None
+        start, start_done = self._stage
+        elapsed = time.time() - start
+        if elapsed <= 0 or self.done <= start_done:
+            return None
+        return (self.done - start_done) / elapsed
+
+    @property
+    def eta(self) -> float:
+        """Estimated seconds to finish current stage."""
+        rate = self.rate
+        if not rate or not self.total:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def progress_text(self) -> str:
+        progress = f"{self.done}/{self.total}" if self.total else str(self.done or '')
+        rate, eta = self.rate, self.eta
+        if rate is not None:
+            progress += f" ({rate:.1f}/s"
+            progress += f", ETA {eta:.0f}s)" if eta is not None else ")"
+        return progress
+
+
+__plugin_jobs__: Dict[int, Job] = dict()
+_job_ids = itertools.count(1)
+_job_local = threading.local()
+_job_executor = None
+_cmd_queue = queue.Queue()
+_cmd_thread = None
+_job_init_lock = threading.Lock()
+
+# minimum seconds between progress lines of foreground commands
+PROGRESS_INTERVAL = 1.0
+# finished background jobs kept for `plugin_jobs`, oldest are dropped
+MAX_FINISHED_JOBS = 20
+
+
+def _prune_finished_jobs(max_jobs: int = None):
+    if max_jobs is None:
+        max_jobs = MAX_FINISHED_JOBS
+    finished = [
+        job_id for job_id, job in list(__plugin_jobs__.items())
+        if job.finished is not None]
+    for job_id in finished[:len(finished) - max_jobs]:
+        __plugin_jobs__.pop(job_id, None)
+
+
+def current_job() -> Job:
+    """
+    Job run by current thread, None if not in a job worker.
+    """
+    return getattr(_job_local, 'job', None)
+
+
+def _in_job_context() -> bool:
+    # progress of current thread already goes to the job of a
+    # worker, the job a queued call runs for on the command
+    # thread, or the foreground command being run.
+    return bool(current_job()
+                or getattr(_job_local, 'owner', None)
+                or getattr(_job_local, 'command', None))
+
+
+def _run_foreground(name: str, call: Callable, args, kwargs):
+    # outermost registered command called from pymol. Its job
+    # entry is only created when it reports progress, and is
+    # removed when the command returns.
+    _job_local.command = name
+    _job_local.command_started = time.time()
+    _job_local.foreground = None
+    try:
+        return call(args, kwargs)
+    except JobCancelled:
+        print(f"{name} cancelled")
+    finally:
+        job = _job_local.foreground
+        _job_local.command = None
+        _job_local.foreground = None
+        if job is not None:
+            __plugin_jobs__.pop(job.id, None)
+
+
+def _foreground_job() -> Job:
+    job = getattr(_job_local, 'foreground', None)
+    if job is None and getattr(_job_local, 'command', None):
+        job = Job(next(_job_ids), _job_local.command)
+        job.foreground = True
+        job.status = 'running'
+        job.submitted = job.started = _job_local.command_started
+        job._reported = time.time()
+        __plugin_jobs__[job.id] = job
+        _job_local.foreground = job
+    return job
+
+
+def _cmd_queue_loop():
+    while True:
+        func, args, kwargs, future, owner, frames = _cmd_queue.get()
+        if not future.set_running_or_notify_cancel():
+            continue
+        _job_local.owner = owner
+        # calls are counted for the command of the job
+        # waiting on this call.
+        _stats_local.frames = frames
+        try:
+            future.set_result(func(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            _job_local.owner = None
+            _stats_local.frames = None
+
+
+def call_on_cmd_thread(func: Callable, *args, **kwargs) -> Any:
+    """
+    Call `func`, marshalled through the single serialized
+    pymol command queue when called from a job worker.
+    Otherwise it is called directly.
+    """
+    global _cmd_thread
+    if current_job() is None:
+        return func(*args, **kwargs)
+    with _job_init_lock:
+        if _cmd_thread is None:
+            _cmd_thread = threading.Thread(
+                target=_cmd_queue_loop, name='gcszhn_cmd_queue', daemon=True)
+            _cmd_thread.start()
+    future = Future()
+    _cmd_queue.put((
+        func, args, kwargs, future, current_job(),
+        getattr(_stats_local, 'frames', None)))
+    return future.result()
+
+
+def on_cmd_thread(func):
+    """
+    Decorate function accessing `pymol.cmd`, so that
+    calls from job workers are marshalled through the
+    serialized pymol command queue.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return call_on_cmd_thread(func, *args, **kwargs)
+
+    return wrapper
+
+
+def progress_job() -> Job:
+    """
+    Job receiving progress of current thread, None
+    out of jobs and registered commands.
+    """
+    return current_job() or getattr(_job_local, 'owner', None) or _foreground_job()
+
+
+def with_checkpoints(func: Callable, job: Job = None) -> Callable:
+    """
+    Bind `func` to run in pool worker threads to the
+    job of the calling thread (see `progress_job`), so
+    `report_progress` in workers stops when the job is
+    cancelled. Progress of workers is not recorded,
+    the thread collecting their results reports it.
+    """
+    if job is None:
+        job = progress_job()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _job_local.checkpoint = job
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _job_local.checkpoint = None
+
+    return wrapper
+
+
+def report_progress(done: int, total: int = None, message: str = None):
+    """
+    Report items processed to current job and check
+    cancellation, raising `JobCancelled` if cancelled.
+    Commands run in foreground get a job entry at their
+    first report, and print progress with rate and ETA
+    at most every `PROGRESS_INTERVAL` seconds. In pool
+    workers bound by `with_checkpoints`, only cancellation
+    is checked. It is a no-op out of jobs and registered
+    commands.
+    """
+    job = progress_job()
+    if job is None:
+        checkpoint = getattr(_job_local, 'checkpoint', None)
+        if checkpoint is not None:
+            checkpoint.check_cancelled()
+        return
+    job.set_progress(done, total, message)
+    job.check_cancelled()
+    if job.foreground:
+        now = time.time()
+        if now - job._reported >= PROGRESS_INTERVAL:
+            job._reported = now
+            print(f"{job.name}: {job.message} {job.progress_text()}")
+
+
+def submit_job(name: str, func: Callable, *args, **kwargs) -> Job:
+    """
+    Run `func` in a background worker thread. Functions
+    run as job should access `pymol.cmd` only by
+    `on_cmd_thread` or `call_on_cmd_thread`.
+    """
+    global _job_executor
+    with _job_init_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(thread_name_prefix='gcszhn_job')
+    job = Job(next(_job_ids), name)
+    __plugin_jobs__[job.id] = job
+
+    def _run():
+        _job_local.job = job
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            job.check_cancelled()
+            job.result = func(*args, **kwargs)
+            job.status = 'done'
+        except JobCancelled:
+            job.status = 'cancelled'
+        except BaseException as e:
+            job.status = 'failed'
+            # keep no traceback, its frames hold the job's data
+            job.error = repr(e)
+            logging.exception(f'job {job.id} ({job.name}) failed')
+        finally:
+            job.finished = time.time()
+            _job_local.job = None
+            _prune_finished_jobs()
+        print(f"job {job.id} ({job.name}) {job.status}")
+
+    job.future = _job_executor.submit(_run)
+    print(f"job {job.id} ({job.name}) submitted")
+    return job
+
+
+@register_pymol_cmd
+def plugin_jobs(action: str = 'list'):
+    """
+    Print status and progress of background jobs.
+    At most `MAX_FINISHED_JOBS` finished jobs are kept.
+
+    Parameters
+    ----------
+    action : str, optional
+        "list" to print jobs, "clear" to remove finished
+        jobs together with their results.
+    """
+    if action == 'clear':
+        _prune_finished_jobs(0)
+        return
+    elif action != 'list':
+        raise ValueError(f"Unknown action: {action}")
+    print(f"{'id':>4}  {'name':<28}{'status':<11}{'progress':>16}"
+          f"{'rate(/s)':>11}{'eta(s)':>9}{'time(s)':>10}  message")
+    now = time.time()
+    # snapshot, workers add and prune jobs concurrently
+    for job in list(__plugin_jobs__.values()):
+        if job.total:
+            progress = f"{job.done}/{job.total}"
+        else:
+            progress = str(job.done or '')
+        rate, eta = job.rate, job.eta
+        rate = '' if rate is None else f"{rate:.1f}"
+        eta = '' if eta is None else f"{eta:.0f}"
+        elapsed = (job.finished or now) - (job.started or now)
+        message = job.message if job.error is None else job.error
+        print(f"{job.id:>4}  {job.name:<28}{job.status:<11}{progress:>16}"
+              f"{rate:>11}{eta:>9}{elapsed:>10.1f}  {message}")
+
+
+@register_pymol_cmd
+def cancel_plugin_job(job_id: str = 'all'):
+    """
+    Cancel background job by id, or all jobs.
+    Running jobs stop at their next checkpoint
+    (`report_progress`). Settings changed by
+    `local_setting` are restored and temporary
+    selections are deleted when they stop.
+
+    Pymol runs typed commands one by one, so a command
+    run in foreground can only be cancelled by a script
+    calling this from another thread. Use the `*_async`
+    variants (such as `load_ply_async`) for work that
+    may need to be cancelled.
+    """
+    if str(job_id) == 'all':
+        jobs = list(__plugin_jobs__.values())
+    else:
+        jobs = [__plugin_jobs__[int(job_id)]]
+    for job in jobs:
+        if job.status in ('pending', 'running'):
+            job.cancel()
+
+
+def int_array_to_ranges(int_array: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Collapse integer array into sorted, inclusive
+    (start, end) runs of continous values.
+    Duplicated values are ignored.
+    """
+    int_array = np.unique(np.asarray(int_array, dtype=np.int64))
+    if len(int_array) == 0:
+        return int_array, int_array
+    breaks = np.flatnonzero(np.diff(int_array) != 1)
+    starts = int_array[np.concatenate(([0], breaks + 1))]
+    ends = int_array[np.concatenate((breaks, [len(int_array) - 1]))]
+    return starts, ends
+
+
+def int_array_to_str(int_array: List[int], prefix="", sep=",") -> str:
     """
     Convert integer array as string.
     original array will be sorted in ascending order
     and continous value will be abbreviated
     """
+    starts, ends = int_array_to_ranges(int_array)
+    return _format_ranges(starts, ends, prefix=prefix, sep=sep)
 
-    if len(int_array) == 0:
-        return ""
 
-    int_array = sorted(int_array)
-    
-    start = int_array[0]
-    end = int_array[0]
+def _format_ranges(starts: np.ndarray, ends: np.ndarray, prefix="", sep=",") -> str:
+    return sep.join(
+        f"{prefix}{start}" if start == end else f"{prefix}{start}-{end}"
+        for start, end in zip(starts.tolist(), ends.tolist()))
 
-    result = []
-    for i in int_array[1:]:
-        if i == end + 1:
-            end = i
-        else:
-            if start == end:
-                result.append(prefix+str(start))
-            else:
-                result.append(f"{prefix}{start}-{end}")
-            start = i
-            end = i
-
-    if start == end:
-        result.append(prefix+str(start))
+
+MAX_SELECTION_RANGES = 1000
+
+
+def compile_index_selection(
+        models: Sequence[str],
+        indices: Sequence[int],
+        key: str = 'index',
+        max_ranges: int = MAX_SELECTION_RANGES) -> List[str]:
+    """
+    Compile atoms given by object names and atom indices
+    into minimal range expressions, such as
+    `(model 1abc and index 1-20+25)`.
+
+    Parameters
+    ----------
+    models: Sequence[str]
+        Object name of each atom.
+    indices: Sequence[int]
+        Atom index (or id/rank, see `key`) of each atom.
+    key: str
+        Numeric atom property selected by ranges.
+    max_ranges: int
+        Maximum number of ranges in one expression.
+        Longer expressions are split into chunks.
+
+    Returns
+    ----------
+    List of expressions whose union is the atoms.
+    """
+    models = np.asarray(models)
+    indices = np.asarray(indices, dtype=np.int64)
+    expressions = []
+    chunk = []
+    chunk_ranges = 0
+
+    def _flush():
+        nonlocal chunk, chunk_ranges
+        if chunk:
+            expressions.append(" or ".join(chunk))
+        chunk = []
+        chunk_ranges = 0
+
+    for model in np.unique(models).tolist():
+        starts, ends = int_array_to_ranges(indices[models == model])
+        for i in range(0, len(starts), max_ranges):
+            ranges = _format_ranges(
+                starts[i:i + max_ranges], ends[i:i + max_ranges], sep="+")
+            n_ranges = min(max_ranges, len(starts) - i)
+            if chunk_ranges + n_ranges > max_ranges:
+                _flush()
+            chunk.append(f"(model {model} and {key} {ranges})")
+            chunk_ranges += n_ranges
+    _flush()
+    return expressions
+
+
+@on_cmd_thread
+def select_indices(
+        name: str,
+        models: Sequence[str],
+        indices: Sequence[int],
+        key: str = 'index',
+        max_ranges: int = MAX_SELECTION_RANGES,
+        enable: int = 0) -> int:
+    """
+    Create named selection from object names and atom indices
+    by compiled range expressions, see `compile_index_selection`.
+    Chunks are merged into the selection one by one.
+
+    Returns
+    ----------
+    Number of atoms selected.
+    """
+    expressions = compile_index_selection(models, indices, key=key, max_ranges=max_ranges)
+    if not expressions:
+        return cmd.select(name, 'none', enable=enable)
+    count = cmd.select(name, expressions[0], enable=enable)
+    for expression in expressions[1:]:
+        count = cmd.select(name, f"{name} or {expression}", enable=enable)
+    return count
+
+
+@on_cmd_thread
+def get_atom_table(
+        selection: str,
+        fields: Sequence[str] = ('model', 'index'),
+        coords: bool = False,
+        state: int = 1) -> Dict[str, np.ndarray]:
+    """
+    Fetch atom properties of selection by one
+    bulk `cmd.iterate` call.
+
+    Parameters
+    ----------
+    selection: str
+        pymol selection string.
+    fields: Sequence[str]
+        Atom properties available in `cmd.iterate`.
+    coords: bool
+        If True, coordinates of `state` are added as
+        "coord" with shape (N, 3). Atoms without
+        coordinates in `state` (such as in multi-state
+        objects with different atoms per state) are
+        left out of the table.
+
+    Returns
+    ----------
+    Dict of property name to array, aligned by atom order.
+    """
+    rows = []
+    cmd.iterate(
+        selection,
+        f"_rows.append(({', '.join(fields)},))",
+        space={'_rows': rows})
+    coord = None
+    if coords and rows:
+        coord = cmd.get_coords(selection, state)
+        if coord is None or len(coord) != len(rows):
+            # some atoms have no coordinates in state, fetch
+            # properties and coordinates of the others in one pass
+            rows = []
+            cmd.iterate_state(
+                state, selection,
+                f"_rows.append(({', '.join(list(fields) + ['x', 'y', 'z'])}))",
+                space={'_rows': rows})
+            coord = np.array([row[-3:] for row in rows], dtype=np.float32).reshape(-1, 3)
+            rows = [row[:-3] for row in rows]
+    columns = list(zip(*rows)) if rows else [()] * len(fields)
+    table = {field: np.array(column) for field, column in zip(fields, columns)}
+    if coords:
+        table['coord'] = np.zeros((0, 3)) if coord is None else coord
+    return table
+
+
+# atom properties identifying a residue, and the
+# residue columns of tables returned by commands.
+RESIDUE_KEYS = ('model', 'segi', 'chain', 'resi')
+RESIDUE_FIELDS = RESIDUE_KEYS + ('resn',)
+
+
+def value_range(values: Sequence[float]) -> Tuple[float, float]:
+    """
+    Minimum and maximum of values for `cmd.spectrum`,
+    ignoring NaN. Empty values give (inf, -inf).
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return float('inf'), -float('inf')
+    return float(values.min()), float(values.max())
+
+
+def map_residue_values(
+        table: Dict[str, np.ndarray],
+        values: Dict[tuple, float],
+        keys: Sequence[str] = RESIDUE_KEYS,
+        default: float = 0.0) -> np.ndarray:
+    """
+    Broadcast residue-key mapping onto atoms.
+
+    Parameters
+    ----------
+    table: Dict[str, np.ndarray]
+        Atom table containing `keys`, see `get_atom_table`.
+    values: Dict[tuple, float]
+        Value of each residue, keyed by tuple of `keys`
+        (or a scalar key if only one key).
+    default: float
+        Value of atoms whose residue is not in mapping.
+
+    Returns
+    ----------
+    Value of each atom, aligned with table.
+    """
+    size = len(table[keys[0]])
+    if not values:
+        return np.full(size, default, dtype=float)
+    if len(keys) > 1:
+        index = pd.MultiIndex.from_arrays([table[k] for k in keys])
     else:
-        result.append(f"{prefix}{start}-{end}")
+        index = pd.Index(table[keys[0]])
+    atom_values = pd.Series(values, dtype=float).reindex(index)
+    return atom_values.fillna(default).to_numpy(dtype=float, copy=True)
+
+
+@on_cmd_thread
+def write_atom_values(selection: str, values: Sequence[float], prop: str = 'b') -> Tuple[float, float]:
+    """
+    Store values aligned with atom order of selection
+    (same as `get_atom_table`) in one `cmd.alter` pass.
+
+    Parameters
+    ----------
+    selection: str
+        pymol selection string.
+    values: Sequence[float]
+        Value of each atom.
+    prop: str
+        Atom property, such as "b", "q", "partial_charge",
+        or custom property like "p.hydration".
+
+    Returns
+    ----------
+    Minimum and maximum of values, see `value_range`.
+    """
+    values = np.asarray(values, dtype=float).ravel()
+    count = cmd.count_atoms(selection)
+    if count != len(values):
+        raise ValueError(
+            f"{len(values)} values for {count} atoms of selection {selection}")
+    cmd.alter(selection, f'{prop} = next(_values)', space={'_values': iter(values.tolist())})
+    return value_range(values)
+
+
+@on_cmd_thread
+def write_residue_values(
+        selection: str,
+        values: Dict[tuple, float],
+        keys: Sequence[str] = RESIDUE_KEYS,
+        prop: str = 'b',
+        default: float = 0.0) -> Tuple[float, float]:
+    """
+    Store residue-key mapping to every atom of
+    selection, see `map_residue_values`.
+    """
+    table = get_atom_table(selection, fields=keys)
+    return write_atom_values(selection, map_residue_values(table, values, keys, default), prop)
+
+
+class PropertyCache:
+    """
+    Thread-safe LRU cache of computed properties,
+    such as per-atom SASA, see `cached_property`.
+    """
+
+    def __init__(self, max_size: int = 32):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
 
-    return ",".join(result)
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            self._evict()
+
+    def resize(self, max_size: int):
+        with self._lock:
+            self.max_size = max_size
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _evict(self):
+        while len(self._items) > max(self.max_size, 0):
+            self._items.popitem(last=False)
+
+
+__property_cache__ = PropertyCache()
+
+
+@on_cmd_thread
+def coord_fingerprint(selection: str, state: int = 1) -> str:
+    """
+    Cheap fingerprint of objects, atom count and coordinates
+    of selection. It changes when atoms are moved, added or
+    removed, but not when other atom properties are altered.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(" ".join(cmd.get_object_list(f"({selection})") or []).encode())
+    coords = cmd.get_coords(selection, state)
+    if coords is not None:
+        digest.update(np.ascontiguousarray(coords, dtype=np.float32).tobytes())
+        digest.update(str(len(coords)).encode())
+    return digest.hexdigest()
+
+
+def atom_fingerprint(selection: str) -> str:
+    """
+    Fingerprint of the atoms (object and index) of
+    selection. It changes when a named selection is
+    redefined to other atoms of the same objects.
+    """
+    atoms = get_atom_table(selection, fields=('model', 'index'))
+    models, model_ids = np.unique(atoms['model'], return_inverse=True)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(" ".join(models.tolist()).encode())
+    digest.update(np.ascontiguousarray(model_ids, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(atoms['index'], dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def _freeze(value):
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, dict):
+        for v in value.values():
+            _freeze(v)
+    return value
+
+
+def cached_property(
+        kind: str,
+        selection: str,
+        params: dict,
+        compute: Callable,
+        scope: str = None,
+        state: int = 1) -> Any:
+    """
+    Get property computed by `compute()` from the property
+    cache, keyed by `kind`, `selection`, `params`, the
+    atoms of selection and coordinate fingerprint of
+    `scope`. Cached arrays are
+    read-only, callers should copy before modifying.
+
+    Parameters
+    ----------
+    kind: str
+        Name of the property, such as "atom_sasa".
+    selection: str
+        pymol selection string the property is computed for.
+    params: dict
+        Parameters of the computation.
+    compute: Callable
+        Function without argument computing the property.
+    scope: str
+        Atoms whose coordinates the property depends on,
+        defaults to whole objects of selection.
+    """
+    if scope is None:
+        scope = f"byobj ({selection})"
+    fingerprint = hashlib.blake2b(
+        (atom_fingerprint(selection) + coord_fingerprint(scope, state)).encode(),
+        digest_size=16).hexdigest()
+    key = (kind, selection, tuple(sorted(params.items())), fingerprint)
+    value = __property_cache__.get(key)
+    if value is None:
+        value = _freeze(compute())
+        __property_cache__.put(key, value)
+    return value
+
+
+@register_pymol_cmd
+def plugin_cache(action: str = 'info', max_size: int = None):
+    """
+    Inspect or clear the property cache of SASA and
+    hydration results.
+
+    Parameters
+    ----------
+    action : str, optional
+        One of "info", "clear".
+        info: print cache statistics and entries.
+        clear: drop all entries.
+    max_size : int, optional
+        Set maximum number of entries, least recently
+        used entries are evicted.
+    """
+    if max_size is not None:
+        __property_cache__.resize(int(max_size))
+    if action == 'clear':
+        __property_cache__.clear()
+    elif action == 'info':
+        cache = __property_cache__
+        print(f"entries: {len(cache)}/{cache.max_size}, hits: {cache.hits}, misses: {cache.misses}")
+        for kind, selection, params, fingerprint in cache.keys():
+            params = ", ".join(f"{k}={v}" for k, v in params)
+            print(f"{kind:<16}{fingerprint[:8]}  {selection}  {params}")
+    else:
+        raise ValueError(f"Unknown action: {action}")
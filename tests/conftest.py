@@ -0,0 +1,21 @@
+"""
+Stub `pymol` when it is not installed, so that the
+helpers not touching pymol can be tested anywhere.
+"""
+import sys
+import types
+
+try:
+    import pymol  # noqa: F401
+except ImportError:
+    pymol = types.ModuleType('pymol')
+    pymol.cmd = types.ModuleType('pymol.cmd')
+    pymol.cgo = types.ModuleType('pymol.cgo')
+    # same values as pymol
+    pymol.cgo.__dict__.update(
+        POINTS=0.0, LINES=1.0, LINE_LOOP=2.0, LINE_STRIP=3.0,
+        TRIANGLES=4.0, TRIANGLE_STRIP=5.0, TRIANGLE_FAN=6.0,
+        STOP=0.0, BEGIN=2.0, END=3.0, VERTEX=4.0, NORMAL=5.0,
+        COLOR=6.0, SPHERE=7.0, LINEWIDTH=10.0, ALPHA=25.0)
+    sys.modules.update({
+        'pymol': pymol, 'pymol.cmd': pymol.cmd, 'pymol.cgo': pymol.cgo})
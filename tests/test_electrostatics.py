@@ -0,0 +1,31 @@
+import numpy as np
+
+from gcszhn_plugin.surface.electrostatics import COULOMB_KT, screened_coulomb
+
+
+def test_screened_coulomb():
+    points = np.array([[2.0, 0, 0], [0, 0, 20.0], [0.5, 0, 0]])
+    potential = screened_coulomb(
+        points, np.zeros((1, 3)), np.array([1.0]),
+        debye_length=8.0, dielectric=4.0, cutoff=12.0, min_distance=1.0)
+    expected = COULOMB_KT / 4.0 * np.exp(-2.0 / 8.0) / 2.0
+    assert np.isclose(potential[0], expected)
+    # beyond cutoff
+    assert potential[1] == 0
+    # closer than min_distance
+    assert np.isclose(potential[2], COULOMB_KT / 4.0 * np.exp(-1.0 / 8.0))
+
+
+def test_screened_coulomb_cutoff_matches_dense():
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, 10, (50, 3))
+    charge_coords = rng.uniform(0, 10, (20, 3))
+    charges = rng.choice([-1.0, 1.0], 20)
+    dense = screened_coulomb(points, charge_coords, charges, cutoff=0)
+    pairs = screened_coulomb(points, charge_coords, charges, cutoff=100.0)
+    assert np.allclose(dense, pairs)
+
+
+def test_screened_coulomb_without_charge():
+    potential = screened_coulomb(np.zeros((3, 3)), np.zeros((0, 3)), np.zeros(0))
+    assert potential.tolist() == [0, 0, 0]
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from gcszhn_plugin.surface.geodesic import geodesic_patches
+from gcszhn_plugin.surface.mesh_utils import ArrayMesh
+
+
+def _strip_mesh(n: int) -> ArrayMesh:
+    # strip of 2 * n vertices with unit spacing along x
+    vertices = np.array([[i, j, 0] for i in range(n) for j in range(2)], dtype=float)
+    faces = [[2 * i, 2 * i + 2, 2 * i + 1] for i in range(n - 1)]
+    faces += [[2 * i + 1, 2 * i + 2, 2 * i + 3] for i in range(n - 1)]
+    return ArrayMesh(vertices, np.array(faces))
+
+
+def test_geodesic_patches():
+    mesh = _strip_mesh(5)
+    patches = geodesic_patches(mesh, [0, 8], radius=1.0)
+    assert patches.ids.tolist() == [0, 8]
+    # seed first, then vertices sorted by distance
+    assert patches[0].tolist()[0] == 0
+    assert sorted(patches[0].tolist()) == [0, 1, 2]
+    assert patches[8].tolist()[0] == 8
+    assert sorted(patches[8].tolist()) == [6, 8, 9]
+
+
+def test_geodesic_patches_seed_out_of_range():
+    with pytest.raises(ValueError):
+        geodesic_patches(_strip_mesh(2), [4], radius=1.0)
@@ -0,0 +1,49 @@
+import numpy as np
+
+from gcszhn_plugin.surface.mesh_utils import (
+    ArrayMesh, SimpleMesh, compute_vertex_normals, write_ply)
+
+# unit square in z = 0 plane, two counter-clockwise triangles
+SQUARE_VERTICES = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]], dtype=float)
+SQUARE_FACES = np.array([[0, 1, 2], [0, 2, 3]])
+
+
+def test_compute_vertex_normals():
+    normals = compute_vertex_normals(SQUARE_VERTICES, SQUARE_FACES)
+    assert np.allclose(normals, [[0, 0, 1]] * 4)
+    normals = compute_vertex_normals(SQUARE_VERTICES, SQUARE_FACES[:, ::-1])
+    assert np.allclose(normals, [[0, 0, -1]] * 4)
+
+
+def test_compute_vertex_normals_without_face():
+    vertices = np.vstack([SQUARE_VERTICES, [[5, 5, 5]]])
+    normals = compute_vertex_normals(vertices, SQUARE_FACES)
+    assert normals[4].tolist() == [0, 0, 0]
+
+
+def test_write_ply_round_trip(tmp_path):
+    filename = str(tmp_path / "square.ply")
+    charge = np.array([-1.0, 0.0, 0.5, 1.0], dtype=np.float32)
+    face_label = np.array([3, 4], dtype=np.int32)
+    write_ply(filename, SQUARE_VERTICES, SQUARE_FACES, {
+        'vertex_charge': charge, 'face_label': face_label})
+
+    mesh = SimpleMesh()
+    mesh.load_mesh(filename)
+    assert mesh.vertices.tolist() == SQUARE_VERTICES.tolist()
+    assert mesh.faces.tolist() == SQUARE_FACES.tolist()
+    assert mesh.get_attribute('vertex_charge').tolist() == charge.tolist()
+    assert mesh.get_attribute('face_label').tolist() == face_label.tolist()
+    assert mesh.get_attribute('vertex_x').dtype == np.float64
+
+
+def test_save_ply_round_trip(tmp_path):
+    filename = str(tmp_path / "square.ply")
+    mesh = ArrayMesh(SQUARE_VERTICES, SQUARE_FACES)
+    mesh.set_attribute('vertex_hphob', np.arange(4.0))
+    mesh.save_ply(filename)
+
+    loaded = SimpleMesh()
+    loaded.load_mesh(filename)
+    assert loaded.get_attribute('vertex_hphob').tolist() == [0, 1, 2, 3]
+    assert np.allclose(loaded.normals, [[0, 0, 1]] * 4)
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from gcszhn_plugin.surface.patch import PatchList
+
+
+def test_patch_list_with_empty_patch():
+    patches = PatchList.from_object_array([[3, 1], [], [7, 8, 9], []])
+    assert len(patches) == 4
+    assert patches.ids.tolist() == [3, -1, 7, -1]
+    assert patches[3].tolist() == [3, 1]
+    assert patches[7].tolist() == [7, 8, 9]
+    vertices, owners = patches.gather([7, 3])
+    assert vertices.tolist() == [7, 8, 9, 3, 1]
+    assert owners.tolist() == [0, 0, 0, 1, 1]
+
+
+def test_patch_list_save_load(tmp_path):
+    patches = PatchList.from_object_array([[], [5, 2]])
+    patches.save(tmp_path / "patches.npz")
+    loaded = PatchList.load(str(tmp_path / "patches.npz"))
+    assert loaded.ids.tolist() == [-1, 5]
+    assert loaded[5].tolist() == [5, 2]
+    with pytest.raises(KeyError):
+        loaded.rows([4])
@@ -0,0 +1,24 @@
+import numpy as np
+
+from scipy.spatial import cKDTree
+from gcszhn_plugin.surface.projection import idw_values
+
+
+def test_idw_values():
+    tree = cKDTree(np.array([[0.0, 0, 0], [2.0, 0, 0]]))
+    values = np.array([1.0, 3.0])
+    points = np.array([[0.0, 0, 0], [1.0, 0, 0], [0.5, 0, 0]])
+    result = idw_values(tree, values, points, k=2)
+    assert np.isclose(result[0], 1.0)
+    assert np.isclose(result[1], 2.0)
+    # weights 1 / 0.5 and 1 / 1.5
+    assert np.isclose(result[2], (1.0 / 0.5 + 3.0 / 1.5) / (1 / 0.5 + 1 / 1.5))
+
+
+def test_idw_values_fill_value():
+    tree = cKDTree(np.array([[0.0, 0, 0], [2.0, 0, 0]]))
+    points = np.array([[0.0, 0, 1.0], [10.0, 0, 0]])
+    result = idw_values(
+        tree, np.array([1.0, 3.0]), points, k=1,
+        distance_threshold=2.0, fill_value=-1.0)
+    assert result.tolist() == [1.0, -1.0]
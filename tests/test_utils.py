@@ -0,0 +1,29 @@
+from gcszhn_plugin.utils import (
+    compile_index_selection, int_array_to_ranges, int_array_to_str)
+
+
+def test_int_array_to_ranges():
+    starts, ends = int_array_to_ranges([7, 1, 2, 3, 3, 10, 9])
+    assert starts.tolist() == [1, 7, 9]
+    assert ends.tolist() == [3, 7, 10]
+    starts, ends = int_array_to_ranges([])
+    assert starts.tolist() == ends.tolist() == []
+
+
+def test_int_array_to_str():
+    assert int_array_to_str([3, 1, 2, 7], "A") == "A1-3,A7"
+    assert int_array_to_str([]) == ""
+
+
+def test_compile_index_selection():
+    expressions = compile_index_selection(
+        ['b', 'a', 'a', 'a', 'b'], [5, 1, 2, 4, 6])
+    assert expressions == ["(model a and index 1-2+4) or (model b and index 5-6)"]
+
+
+def test_compile_index_selection_chunks():
+    expressions = compile_index_selection(
+        ['a'] * 3 + ['b'], [1, 3, 5, 1], key='id', max_ranges=2)
+    assert expressions == [
+        "(model a and id 1+3)",
+        "(model a and id 5) or (model b and id 1)"]